@@ -0,0 +1,296 @@
+# --------BENCHMARKS--------
+# Every benchmark is a function that returns {result name: {metric: value}}. Metrics are
+#     ops_per_sec      - higher is better
+#     bytes_per_frame  - terminal output per rendered frame, lower is better
+#     peak_kb          - peak memory allocated during one operation (tracemalloc), lower is better
+#     latency_us       - microseconds from a key press to the consumer getting it, lower is better
+#     writes_per_1000  - terminal write syscalls per 1000 prints, lower is better
+#     boot_ms          - milliseconds main.py takes to boot and run an empty batch script, lower is better
+# Nothing here needs a terminal, so the suite also runs in CI.
+
+import os
+import io
+import sys
+import time
+import random
+import timeit
+import threading
+import builtins
+import contextlib
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same order kernel.py loads them in, but eagerly and without starting the shell or the mainloop
+KERNEL_MODULES = [
+    "kernel.modules.ansi", "sys", "os", "re", "select", "builtins", "_thread", "asyncio", "time", "kernel.modules.trace",
+    "kernel.modules.console", "kernel.modules.keyboard", "kernel.modules.diskimage", "kernel.modules.vfs", "kernel.modules.api",
+    "kernel.modules.pixel", "kernel.modules.interpreter", "kernel.modules.procpool", "kernel.modules.compositor",
+    "kernel.modules.scheduler", "kernel.ede", "kernel.modules.shellwrapper",
+]
+
+registry = {}
+
+
+def boot():
+    """Loads the kernel modules into a registry, benchmarks pick their modules out of it."""
+    if registry:
+        return registry
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(ROOT)  # fs/ is mounted relative to the working directory
+    builtins.__elaptic_registry__ = registry
+    for module_path in KERNEL_MODULES:
+        __import__(module_path)
+        registry[module_path.split(".")[-1]] = sys.modules[module_path]
+    return registry
+
+
+def ops_per_sec(function, repeat=3):
+    """Runs function for at least 0.2 s per round and returns the best calls per second."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return number / min(timer.repeat(repeat, number))
+
+
+def peak_kb(function):
+    """Peak memory one call of function allocates, in KB."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+# --- pixel ---
+
+def _scene(pixel, width_chars, height_chars, sprite_count):
+    random.seed(sprite_count)
+    screen = pixel.Screen(width_chars, height_chars)
+    tiles = pixel.Tileset(8, 8)
+    tiles.add([0x101820] * 64)
+    screen.add_sprite(pixel.TileMap(tiles, 1, 1, screen.width_pixels, screen.height_pixels, [0], wrap=True))
+    sprites = []
+    for _ in range(sprite_count):
+        sprite = pixel.Bitmap(8, 8, [random.choice((0, 0xff8800, 0x3366ff, 0xeeeeee)) for _ in range(64)])
+        sprite.set_position(random.randrange(screen.width_pixels), random.randrange(screen.height_pixels))
+        screen.add_sprite(sprite)
+        sprites.append(sprite)
+    screen.render_delta()
+    return screen, sprites
+
+
+def bench_render():
+    pixel = boot()["pixel"]
+    results = {}
+    for width_chars, height_chars in ((32, 16), (100, 40), (200, 60)):
+        for sprite_count in (10, 100, 1000):
+            name = f"render/{width_chars}x{height_chars}/{sprite_count}"
+            screen, sprites = _scene(pixel, width_chars, height_chars, sprite_count)
+            moving = sprites[-10:]  # the topmost ones, so their changes actually show
+
+            def full_frame():
+                screen.invalidate()
+                screen.render()
+
+            def delta_frame():
+                for sprite in moving:
+                    # Wander around without leaving the screen
+                    sprite.set_position((sprite.x + random.choice((-1, 1))) % screen.width_pixels,
+                                        (sprite.y + random.choice((-1, 1))) % screen.height_pixels)
+                return screen.render_delta()
+
+            frame_bytes = sum(len(delta_frame().encode("utf-8")) for _ in range(50)) / 50
+            results[name + "/full"] = {"ops_per_sec": ops_per_sec(full_frame), "peak_kb": peak_kb(full_frame)}
+            results[name + "/delta"] = {
+                "ops_per_sec": ops_per_sec(delta_frame),
+                "bytes_per_frame": frame_bytes,
+                "peak_kb": peak_kb(delta_frame),
+            }
+    return results
+
+
+def bench_windows():
+    """Program windows as the compositor has them: four surfaces, one program draws a frame at a time."""
+    pixel = boot()["pixel"]
+    screen, _ = _scene(pixel, 100, 40, 10)
+    surfaces = []
+    for index in range(4):
+        surface = pixel.Surface(40, 30, 0x101040)
+        surface.set_position(8 + (index % 2) * 48, 4 + (index // 2) * 40)
+        surface.set_z(10)
+        screen.add_sprite(surface)
+        surfaces.append(surface)
+    screen.render_delta()
+    tick = [0]
+
+    def one_window_frame():
+        surface = surfaces[tick[0] % 4]
+        x = tick[0] % 37
+        tick[0] += 1
+        surface.fill(0x101040, 0, 10, 40, 3)  # erase the ball's row, draw it one pixel further
+        surface.fill(0xff8800, x, 10, 3, 3)
+        surface.present()
+        return screen.render_delta()
+
+    frame_bytes = sum(len(one_window_frame().encode("utf-8")) for _ in range(50)) / 50
+    return {"windows/4_surfaces/one_changed": {"ops_per_sec": ops_per_sec(one_window_frame), "bytes_per_frame": frame_bytes}}
+
+
+def bench_rgb_to_ansi():
+    pixel = boot()["pixel"]
+    colors = [random.randrange(0x1000000) for _ in range(1000)]
+    results = {}
+    for mode in pixel.COLOR_MODES:
+        def convert():
+            for color in colors:
+                pixel.Screen.rgb_to_ansi(color, False, mode)
+        results[f"rgb_to_ansi/{mode}"] = {"ops_per_sec": ops_per_sec(convert) * len(colors)}
+    return results
+
+
+def bench_bitmap():
+    pixel = boot()["pixel"]
+    pixels = [random.choice((0, 0x112233, 0x445566, 0xffffff)) for _ in range(256 * 256)]
+    sprite_file = pixel.encode_sprite(32, 32, pixels[:1024])
+    return {
+        "bitmap/256x256": {
+            "ops_per_sec": ops_per_sec(lambda: pixel.Bitmap(256, 256, pixels)),
+            "peak_kb": peak_kb(lambda: pixel.Bitmap(256, 256, pixels)),
+        },
+        "bitmap/load_sprite_32x32": {"ops_per_sec": ops_per_sec(lambda: pixel.load_sprite(sprite_file))},
+    }
+
+
+# --- interpreter and shell ---
+
+def bench_interpreter():
+    interpreter = boot()["interpreter"]
+    script = "total = 0\nfor i in range(10):\n    total += i\n"
+    return {
+        "interpreter/run_script": {"ops_per_sec": ops_per_sec(lambda: interpreter.run_script(script))},
+        "interpreter/run_shell_command": {"ops_per_sec": ops_per_sec(lambda: interpreter.run_shell_command("x = 1 + 1"))},
+    }
+
+
+def bench_shell():
+    shellwrapper = boot()["shellwrapper"]
+
+    def dispatch(command):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                shellwrapper.run_shell_command(command)
+        return run
+
+    script = ["ls /programs", "sync", "# comment", "help"] * 250
+
+    def batch():
+        shellwrapper.run_batch(script, io.StringIO())
+
+    return {
+        "shell/dispatch_sync": {"ops_per_sec": ops_per_sec(dispatch("sync"))},
+        "shell/ls": {"ops_per_sec": ops_per_sec(dispatch("ls /programs"))},
+        "shell/batch_1000_lines": {"ops_per_sec": ops_per_sec(batch) * len(script)},
+    }
+
+
+# --- console ---
+
+def bench_console(lines=10000):
+    console = boot()["console"]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    old_fd, console.fd = console.fd, devnull
+
+    def chatty():
+        for index in range(lines):
+            console.write("bench", f"line {index}\n")
+        console.flush()
+
+    try:
+        console.flush()
+        writes_before = console.writes
+        chatty()
+        return {"console/small_prints": {"ops_per_sec": ops_per_sec(chatty) * lines,
+                                         "writes_per_1000": (console.writes - writes_before) * 1000 / lines}}
+    finally:
+        console.close("bench")
+        console.fd = old_fd
+        os.close(devnull)
+
+
+# --- keyboard ---
+
+def _feed_keys(keyboard, source, count, on_key=None):
+    """Runs a scripted source through the keyboard thread and takes count keys out of the queue, returns the seconds it took."""
+    keyboard.clear_keys()
+    keyboard.use_input_source(source)
+    keyboard.start_keyboard_monitoring()
+    started = time.perf_counter()
+    try:
+        for _ in range(count):
+            if keyboard.get_key(1) is None:
+                break
+            if on_key is not None:
+                on_key()
+    finally:
+        keyboard.use_input_source(None)
+    return time.perf_counter() - started
+
+
+def bench_keyboard(count=2000):
+    keyboard = boot()["keyboard"]
+
+    # Latency: one key at a time, the next one only goes out once the last one arrived
+    sent = []
+    latencies = []
+    received = threading.Event()
+
+    def one_at_a_time():
+        for index in range(count):
+            received.clear()
+            sent.append(time.perf_counter())
+            yield "UP" if index % 2 else "DOWN"
+            received.wait(1)
+
+    def arrived():
+        latencies.append(time.perf_counter() - sent[len(latencies)])
+        received.set()
+
+    _feed_keys(keyboard, one_at_a_time(), count, arrived)
+    latencies.sort()
+
+    # Throughput: a burst of keys as fast as the queue takes them
+    burst_time = _feed_keys(keyboard, ("UP" if index % 2 else "DOWN" for index in range(count)), count)
+    return {
+        "keyboard/latency": {"latency_us": latencies[len(latencies) // 2] * 1e6},
+        "keyboard/burst": {"ops_per_sec": count / burst_time},
+    }
+
+
+# --- boot ---
+
+def bench_boot(runs=5):
+    """Boots main.py in batch mode with nothing to run, so this is boot plus shutdown."""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "main.py"], cwd=ROOT, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+        times.append(time.perf_counter() - started)
+    boot_time = sorted(times)[len(times) // 2]
+    return {"boot/main.py": {"ops_per_sec": 1 / boot_time, "boot_ms": boot_time * 1000}}
+
+
+BENCHMARKS = {
+    "render": bench_render,
+    "windows": bench_windows,
+    "rgb_to_ansi": bench_rgb_to_ansi,
+    "bitmap": bench_bitmap,
+    "interpreter": bench_interpreter,
+    "shell": bench_shell,
+    "console": bench_console,
+    "keyboard": bench_keyboard,
+    "boot": bench_boot,
+}
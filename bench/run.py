@@ -0,0 +1,93 @@
+# Runs the benchmark suite and writes the results as JSON
+#     python bench/run.py                          everything, results go to bench/results.json
+#     python bench/run.py render shell             only some groups
+#     python bench/run.py --save-baseline          also save the results as bench/baseline.json
+#     python bench/run.py --compare bench/baseline.json
+# With --compare the exit code is 1 when a metric got worse by more than --threshold percent.
+
+import os
+import sys
+import json
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench import benchmarks
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HIGHER_IS_BETTER = {"ops_per_sec"}
+
+
+def run(groups):
+    results = {}
+    for group in groups:
+        print(f"running {group}...", file=sys.stderr)
+        results.update(benchmarks.BENCHMARKS[group]())
+    return {
+        "python": platform.python_version(),
+        "platform": sys.platform,
+        "numpy": benchmarks.boot()["pixel"].numpy is not None,
+        "results": results,
+    }
+
+
+def print_results(results):
+    for name, metrics in results["results"].items():
+        line = "  ".join(f"{metric}={value:,.1f}" for metric, value in metrics.items())
+        print(f"{name:<36} {line}")
+
+
+def compare(results, baseline, threshold):
+    """Prints every metric next to the baseline and returns the names of the ones that regressed."""
+    regressions = []
+    for name, metrics in results["results"].items():
+        old_metrics = baseline["results"].get(name)
+        if old_metrics is None:
+            print(f"{name:<36} (new)")
+            continue
+        for metric, value in metrics.items():
+            old_value = old_metrics.get(metric)
+            if not old_value:
+                continue
+            change = (value - old_value) / old_value * 100
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<36} {metric:<16} {old_value:>14,.1f} -> {value:>14,.1f}  {change:+6.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ElapticOS benchmarks")
+    parser.add_argument("groups", nargs="*", help=f"groups to run: {', '.join(benchmarks.BENCHMARKS)} (default: all)")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results.json"), help="where to write the results")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a saved results file")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent a metric may get worse before it counts as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to bench/baseline.json")
+    args = parser.parse_args()
+
+    unknown = [group for group in args.groups if group not in benchmarks.BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown group(s): {', '.join(unknown)}")
+    results = run(args.groups or list(benchmarks.BENCHMARKS))
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(os.path.join(BENCH_DIR, "baseline.json"), "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""
+    0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0xff8800, 0xff8800, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0xff8800, 0xff8800, 0xff8800, 0xff8800, 0x101040, 0x101040, 0x101040, 0x101040, 0xff8800, 0xff8800, 0xff8800, 0xff8800, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0xff8800, 0xff8800, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040, 0x101040
+"""
+# draws into its own window on the desktop, start a few and tab between them
+# q in the focused window quits
+
+WIDTH = 24
+HEIGHT = 16
+window = api.open_window(WIDTH, HEIGHT, "bounce")
+x, y = 0, 0
+dx, dy = 1, 1
+while api.window_key(window) != "q":
+    api.fill_window(window, 0x101040)
+    api.fill_window(window, 0xff8800, x, y, 3, 3)
+    x += dx
+    y += dy
+    if x <= 0 or x >= WIDTH - 3:
+        dx = -dx
+    if y <= 0 or y >= HEIGHT - 3:
+        dy = -dy
+    api.sleep(1 / 30)
+api.close_window(window)
@@ -8,7 +8,21 @@ re = __elaptic_registry__['re']
 os = __elaptic_registry__['os']
 keyboard = __elaptic_registry__['keyboard']
 interpreter = __elaptic_registry__['interpreter']
+vfs = __elaptic_registry__['vfs']
 _thread = __elaptic_registry__['_thread']
+sys = __elaptic_registry__['sys']
+trace = __elaptic_registry__['trace']
+console = __elaptic_registry__['console']
+compositor = __elaptic_registry__['compositor']
+import ast
+import struct
+from array import array
+
+PROGRAMS_DIR = "/programs" # vfs path, so the desktop works the same when booted from an image
+ICON_INDEX_NAME = ".icons.idx" # binary sidecar inside PROGRAMS_DIR, a dotfile so ls leaves it out
+DEFAULT_ICON = [0x434343] * 64 # shown for programs without an icon
+DESKTOP_SIZE = (32, 16) # in characters, on a terminal the desktop grows to fill it
+WINDOW_MOVES = {"UP": (0, -2), "DOWN": (0, 2), "LEFT": (-1, 0), "RIGHT": (1, 0)} # arrow keys while a window has focus, one character cell
 
 def lastkey(reset = False):
     last_key = keyboard.last_key
@@ -17,36 +31,157 @@ def lastkey(reset = False):
     return last_key
 
 def get_program_icon(filepath):
-    """Finds the first triple-quoted block in a file and evals it as a list."""
+    """Finds the first triple-quoted block in a file and parses it as a list of colors with ast.literal_eval (no code runs)."""
+    try:
+        # Only read the start of the file to save memory
+        content = vfs.read(filepath, 0, 2048).decode("utf-8", errors="ignore")
+
+        # Find content between first occurrence of """..."""
+        # re.DOTALL allows the dot to match newlines
+        match = re.search(r'"""(.*?)"""', content, re.DOTALL)
+
+        if match:
+            # Extract the string inside the quotes
+            list_str = match.group(1).strip()
+            # Parse the string into a Python list, literal_eval only accepts plain values so a program can't run code here
+            return list(ast.literal_eval(f"[{list_str}]"))
+    except Exception as e:
+        print(f"Error loading icon from {filepath}: {e}")
+    return None
+
+def get_sprite_icon(filepath):
+    """Loads an icon from a binary .spr sidecar (see pixel.encode_sprite), icons have to be 8x8."""
     try:
-        with open(filepath, 'r') as f:
-            # Only read the start of the file to save memory
-            content = f.read(2048) 
-            
-            # Find content between first occurrence of """..."""
-            # re.DOTALL allows the dot to match newlines
-            match = re.search(r'"""(.*?)"""', content, re.DOTALL)
-            
-            if match:
-                # Extract the string inside the quotes
-                list_str = match.group(1).strip()
-                # Evaluate the string into a Python list
-                return eval(list_str)
+        width, height, pixels = pixel.decode_sprite(vfs.read_view(filepath))
+        if width == 8 and height == 8:
+            return pixels
+        print(f"Icon {filepath} is {width}x{height}, icons have to be 8x8")
     except Exception as e:
         print(f"Error loading icon from {filepath}: {e}")
     return None
 
+class IconIndex:
+    """
+    Program icons keyed by file name and validated against each file's mtime and size.
+    A <program>.spr sidecar next to a program wins over the hex list in its docstring.
+    The index is kept in a binary sidecar, so opening the desktop only re-parses programs that changed.
+
+    Sidecar layout (little endian):
+        header: b"EIDX", version (H), entry count (I)
+        entry:  name length (H), mtime_ns (q), size (q), pixel count (I), name (utf-8), pixels (I each)
+    """
+    MAGIC = b"EIDX"
+    VERSION = 1
+    _HEADER = struct.Struct("<4sHI")
+    _ENTRY = struct.Struct("<HqqI")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = f"{directory}/{ICON_INDEX_NAME}"
+        self.entries = {} # name -> (mtime_ns, size, packed pixel bytes)
+        self._icons = {} # name -> decoded pixels, filled in on first use
+        self._load()
+
+    def _load(self):
+        try:
+            data = vfs.read(self.path)
+            magic, version, count = self._HEADER.unpack_from(data, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                return
+            offset = self._HEADER.size
+            view = memoryview(data)
+            for _ in range(count):
+                name_length, mtime_ns, size, pixel_count = self._ENTRY.unpack_from(data, offset)
+                offset += self._ENTRY.size
+                name = bytes(view[offset:offset + name_length]).decode("utf-8")
+                offset += name_length
+                if pixel_count not in (0, 64) or offset + pixel_count * 4 > len(data):
+                    raise ValueError("truncated or corrupt icon index") # icons are 8x8 or missing
+                # Pixels stay packed until someone asks for this icon
+                self.entries[name] = (mtime_ns, size, view[offset:offset + pixel_count * 4])
+                offset += pixel_count * 4
+        except (OSError, struct.error, UnicodeDecodeError, ValueError):
+            self.entries = {} # missing or broken index, it gets rebuilt by refresh()
+
+    def save(self):
+        chunks = [self._HEADER.pack(self.MAGIC, self.VERSION, len(self.entries))]
+        for name, (mtime_ns, size, packed) in self.entries.items():
+            encoded_name = name.encode("utf-8")
+            chunks.append(self._ENTRY.pack(len(encoded_name), mtime_ns, size, len(packed) // 4))
+            chunks.append(encoded_name)
+            chunks.append(bytes(packed))
+        try:
+            vfs.write(self.path, b"".join(chunks))
+        except OSError:
+            pass # read-only fs, we just re-parse next time
+
+    def refresh(self):
+        """Re-parses programs that are new or changed, drops removed ones and saves the index if anything changed."""
+        changed = False
+        seen = set()
+        for name in vfs.listdir(self.directory):
+            if not name.endswith(".py"):
+                continue
+            seen.add(name)
+            path = f"{self.directory}/{name}"
+            sprite_path = f"{self.directory}/{name[:-3]}.spr"
+            sprite_stat = vfs.stat(sprite_path)
+            stat = sprite_stat or vfs.stat(path) # validate against whichever file the icon comes from
+            cached = self.entries.get(name)
+            if cached is not None and cached[0] == stat.mtime_ns and cached[1] == stat.size:
+                continue
+            icon = get_sprite_icon(sprite_path) if sprite_stat is not None else None
+            pixels = array("I", icon or get_program_icon(path) or [])
+            if sys.byteorder != "little":
+                pixels.byteswap()
+            self.entries[name] = (stat.mtime_ns, stat.size, pixels.tobytes())
+            self._icons.pop(name, None)
+            changed = True
+        for name in list(self.entries):
+            if name not in seen:
+                del self.entries[name]
+                self._icons.pop(name, None)
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def names(self):
+        return sorted(self.entries)
+
+    def icon(self, name):
+        """Returns the icon pixels for a program, or None if it has no icon."""
+        if name not in self._icons:
+            try:
+                pixels = self._decode(self.entries[name][2])
+            except ValueError:
+                # Broken entry, parse the program again (and save the fixed index), the default icon otherwise
+                del self.entries[name]
+                self.refresh()
+                try:
+                    pixels = self._decode(self.entries.get(name, (0, 0, b""))[2])
+                except ValueError:
+                    pixels = None
+            self._icons[name] = pixels
+        return self._icons[name]
+
+    @staticmethod
+    def _decode(packed):
+        if not len(packed):
+            return None
+        pixels = array("I", bytes(packed))
+        if len(pixels) != 64:
+            raise ValueError(f"icons are 8x8, this one has {len(pixels)} pixels")
+        if sys.byteorder != "little":
+            pixels.byteswap()
+        return pixels
+
 def scan_directory(directory_path):
-    """Scans fs/programs and sets icons."""
-    icons = {}
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".py"):
-            path = os.path.join(directory_path, filename)
-            icon_data = get_program_icon(path)
-            icons[filename] = icon_data
-    return icons
-
-program_icons = scan_directory("fs/programs")
+    """Scans a programs directory and returns their icons, going through the icon index."""
+    index = IconIndex(directory_path)
+    index.refresh()
+    return {name: index.icon(name) for name in index.names()}
+
 desktop_elements = ["selector", "icon1", "icon2"]
 program_elements = ["selector", "icon1", "icon2"]
 
@@ -62,40 +197,159 @@ def hidedesktop():
     for element in program_elements:
         eval(f"{element}.show()")
 
-def desktop_main():
+class FrameScheduler:
+    """
+    Paces the desktop loop: it wakes up right away on input, only lets a frame through when
+    something is dirty, and never draws more than target_fps frames a second.
+    """
+    def __init__(self, target_fps=30, idle_timeout=1.0):
+        self.target_fps = target_fps
+        self.idle_timeout = idle_timeout  # how long to sleep when nothing needs drawing
+        self.fps = 0.0  # frames actually drawn per second, measured over the last second
+        self.frame_time = 0.0  # seconds the last frame took to render and write
+        self.frames = 0  # total frames drawn
+        self._next_frame = 0.0
+        self._frame_start = 0.0
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+
+    def wait(self, dirty):
+        """Returns the next KeyEvent, or None once the next frame is due (or after idle_timeout when nothing is dirty)."""
+        if dirty:
+            timeout = max(0.0, self._next_frame - time.monotonic())
+        else:
+            timeout = self.idle_timeout
+        return keyboard.get_key(timeout, wakeable=True) # compositor.sync() has something to draw when woken
+
+    def frame_due(self):
+        return time.monotonic() >= self._next_frame
+
+    def begin_frame(self):
+        self._frame_start = time.monotonic()
+        self._next_frame = self._frame_start + 1 / self.target_fps
+
+    def end_frame(self):
+        now = time.monotonic()
+        self.frame_time = now - self._frame_start
+        self.frames += 1
+        self._window_frames += 1
+        if now - self._window_start >= 1.0:
+            self.fps = self._window_frames / (now - self._window_start)
+            self._window_start = now
+            self._window_frames = 0
+
+    def stats(self):
+        return f"{self.fps:5.1f} fps | {self.frame_time * 1000:6.2f} ms/frame | {self.frames} frames"
+
+
+frame_stats = "" # stats of the last desktop session, handy after leaving it
+
+def desktop_main(target_fps = 30, show_stats = False, color_mode = None, output = None, keys = None):
+    """
+    Runs the desktop until esc is pressed or, with keys, until they run out, and returns the procpool.Programs started from it.
+    Enter starts the selected program and the desktop stays up, programs that open windows (api.open_window) show up
+    in them. Tab gives the next window focus: arrows then move it, other keys go to its program, esc hands them back.
+    output gets the frames instead of stdout (e.g. a pixel.FrameSink or pixel.FrameRecorder), keys is
+    scripted input for keyboard.use_input_source(). Together they run the desktop without a terminal.
+    Background programs' output waits in the console until the desktop is gone, so it can't tear a frame.
+    """
+    global frame_stats
+    if keys is None and not keyboard.has_input():
+        # Piped stdin, nothing could ever press esc
+        frame_stats = ""
+        print("ede needs a terminal for its keys, stdin isn't one")
+        return []
+    if output is None:
+        output = console.FrameOutput() # one write per frame
+    if keys is not None:
+        keyboard.use_input_source(keys)
+    console.hold()
+    try:
+        return _run_desktop(target_fps, show_stats, color_mode, output, keys is not None)
+    finally:
+        compositor.detach()
+        console.release()
+        if keys is not None:
+            keyboard.use_input_source(None)
+
+def _run_desktop(target_fps, show_stats, color_mode, output, scripted):
+    global frame_stats
     running_desktop = True # this controls the while loop, if it is set to false it should stop the display manager loop, which can be called again to restart
     selector_grid_x = 0
     selector_grid_y = 0
     
-    screen = pixel.Screen(32, 16)
-    background = pixel.Bitmap(32, 32, ([0x010101]) * 32 * 32)  # black background fill
-    background.set_position(0, 0)
+    width_chars, height_chars = DESKTOP_SIZE
+    if getattr(output, "isatty", lambda: False)():
+        # The whole terminal, so program windows fit side by side. One line stays free for the stats.
+        try:
+            columns, lines = os.get_terminal_size(sys.__stdout__.fileno())
+            width_chars, height_chars = max(width_chars, columns), max(height_chars, lines - 1)
+        except (AttributeError, ValueError, OSError):
+            pass
+    screen = pixel.Screen(width_chars, height_chars, color_mode) # color_mode None means pixel.DEFAULT_COLOR_MODE
+    # Black background fill, one shared 8x8 tile repeated over the whole screen
+    background_tiles = pixel.Tileset(8, 8)
+    background_tiles.add([0x010101] * 64)
+    background = pixel.TileMap(background_tiles, 1, 1, screen.width_pixels, screen.height_pixels, [0], wrap=True)
+    background.set_z(-1)
     screen.add_sprite(background)
 
-    icon1 = pixel.Bitmap(8, 8, program_icons["program1.py"])
-    icon1.set_position(1,1)
-    screen.add_sprite(icon1)
+    # The grid comes from the icon index, icons are 8x8 with 3 pixels between them
+    icon_index = IconIndex(PROGRAMS_DIR)
+    icon_index.refresh()
+    programs = icon_index.names()
+    columns = max(1, (screen.width_pixels - 8) // 11 + 1)
+    visible_rows = max(1, (screen.height_pixels - 8) // 11 + 1)
+    scroll_row = 0 # first grid row on screen
+    icon_sprites = {} # program name -> Bitmap, only built once the icon scrolls into view
 
-    icon2 = pixel.Bitmap(8, 8, program_icons["program2.py"])
-    icon2.set_position(12,1)
-    screen.add_sprite(icon2)
+    def layout_icons():
+        for sprite in icon_sprites.values():
+            sprite.hide()
+        first = scroll_row * columns
+        for slot, name in enumerate(programs[first:first + visible_rows * columns]):
+            if name not in icon_sprites:
+                icon_sprites[name] = pixel.Bitmap(8, 8, icon_index.icon(name) or DEFAULT_ICON)
+                screen.add_sprite(icon_sprites[name])
+            icon_sprites[name].set_position(1 + (slot % columns) * 11, 1 + (slot // columns) * 11)
+            icon_sprites[name].show()
 
-    icon2 = pixel.Bitmap(8, 8, program_icons["program3.py"])
-    icon2.set_position(12 + 11,1)
-    screen.add_sprite(icon2)
+    layout_icons()
 
     # Create selector
     selector = pixel.Bitmap(8, 8, [0x00ff11, 0x000000, 0x000000, 0x00ff11, 0x00ff11, 0x000000, 0x000000, 0x00ff11, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x00ff11, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x00ff11, 0x00ff11, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x00ff11, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x000000, 0x00ff11, 0x000000, 0x000000, 0x00ff11, 0x00ff11, 0x000000, 0x000000, 0x00ff11])
+    selector.set_z(1) # stay above icons that get added while scrolling
     screen.add_sprite(selector)
 
+    keyboard.clear_keys() # don't act on keys pressed before the desktop opened
     keyboard.start_keyboard_monitoring() #need keyboard for navigation
+    compositor.attach(screen) # program windows go on top of the icons
+    launched = []
+
+    scheduler = FrameScheduler(target_fps)
 
     while running_desktop:
-        time.sleep(0.5)
-        key = keyboard.get_last_key_pressed(True)
+        if scripted and not screen.is_dirty() and keyboard.input_finished():
+            break # scripted input ran out and everything is drawn
+        event = scheduler.wait(screen.is_dirty()) # wakes up as soon as a key is pressed (or a window changes)
+        key = event.key if event else None
 
-        if key == "RIGHT":
-            if selector_grid_x < 2:
+        if key == "\t":
+            compositor.focus_next()
+
+        elif compositor.focused is not None: # a window has the keys
+            if key in WINDOW_MOVES:
+                compositor.move_focused(*WINDOW_MOVES[key])
+            elif key == "ESC":
+                compositor.unfocus()
+            elif key is not None:
+                compositor.send_key(key)
+
+        elif key == "ESC":
+            running_desktop = False
+
+        elif key == "RIGHT":
+            if selector_grid_x < columns - 1 and selector_grid_y * columns + selector_grid_x + 1 < len(programs):
                 selector_grid_x += 1
 
         elif key == "LEFT":
@@ -103,7 +357,7 @@ def desktop_main():
                 selector_grid_x -= 1
 
         elif key == "DOWN":
-            if selector_grid_y < 2:
+            if (selector_grid_y + 1) * columns + selector_grid_x < len(programs):
                 selector_grid_y += 1
 
         elif key == "UP":
@@ -111,25 +365,37 @@ def desktop_main():
                 selector_grid_y -= 1
 
 
-        elif key == "ENTER": # run the selected program
-            running_desktop = False
-            programselection = ""
-            if selector_grid_x == 0 and selector_grid_y == 0: # we are hardcoding this because i don't know how else we should do it
-                programselection = "1"
-            if selector_grid_x == 1 and selector_grid_y == 0:
-                programselection = "2"
-            if selector_grid_x == 3 and selector_grid_y == 0:
-                programselection = "3"
-            with open(f"fs/programs/program{programselection}.py", "r") as f:
-
-                script_content = f.read()
-
-                def script_wrapper():
-                    # The interpreter.run_script function likely needs the content as an argument
-                    interpreter.run_script(script_content)
-
-                return _thread.start_new_thread(script_wrapper())
-            break
-
-        selector.set_position(1 + (selector_grid_x * 11), 1 + (selector_grid_y * 11))
-        print(f"\n\n\n\n{ansi.ansi['clear']}{screen.render()}")
+        elif key == "ENTER": # run the selected program, the desktop stays up and its windows show up on it
+            if programs:
+                programselection = programs[selector_grid_y * columns + selector_grid_x]
+
+                # Same as 'run'/'bg' at the shell (shellwrapper.start_program): a task if it uses top-level await, otherwise its own worker
+                # process, so a program that never ends can't take the desktop or shell with it
+                launched.append(__elaptic_registry__['shellwrapper'].start_program([f"{PROGRAMS_DIR}/{programselection}"]))
+
+        # Scroll the grid so the selected row stays on screen
+        if selector_grid_y < scroll_row:
+            scroll_row = selector_grid_y
+            layout_icons()
+        elif selector_grid_y >= scroll_row + visible_rows:
+            scroll_row = selector_grid_y - visible_rows + 1
+            layout_icons()
+        selector.set_position(1 + (selector_grid_x * 11), 1 + ((selector_grid_y - scroll_row) * 11))
+
+        compositor.sync() # whatever programs drew into their windows since the last loop
+
+        # Nothing changed or we're ahead of the frame cap? then skip drawing
+        if not screen.is_dirty() or not scheduler.frame_due():
+            continue
+        scheduler.begin_frame()
+        with trace.span("frame", "ede"):
+            # Only send the cells that changed since the last frame, the first frame clears the terminal
+            frame = screen.render_delta()
+            if show_stats:
+                frame += f"\033[{screen.height_chars + 1};1H\033[2K{scheduler.stats()}"
+            output.write(frame)
+            output.flush()
+        trace.count("ede.frame_bytes", len(frame))
+        scheduler.end_frame()
+        frame_stats = scheduler.stats()
+    return launched
@@ -4,54 +4,106 @@ import _thread
 # I just like having high level access to imports in the environment of an operating system :p
 import sys
 
+import time as _boot_clock
+_boot_started = _boot_clock.perf_counter()
+import os as _os
+_main_thread = _thread.get_ident()
+
+VERBOSE_BOOT = False # print a line for every module that gets registered
+
+
+class ModuleRegistry(dict):
+    """
+    Maps short module names to loaded modules. Modules registered as lazy are only imported
+    the first time someone looks them up; background ones are being imported by a boot thread
+    and a lookup just waits for that import to finish.
+    """
+    def __init__(self):
+        super().__init__()
+        self.pending = {} # short name -> (module_path, important) for modules not loaded yet
+        self.boot_times = {} # short name -> seconds its import took (including modules it pulled in)
+        self.boot_started = _boot_started
+        self.prompt_ready = None # perf_counter() when the first shell prompt showed up
+        # Held while a module goes from pending to loaded, so a lookup never sees it in neither.
+        # Not held during the import itself, the module might look things up on another thread.
+        self.lock = _thread.RLock()
+
+    def __missing__(self, key):
+        with self.lock:
+            if dict.__contains__(self, key): # the boot thread finished it since the lookup missed
+                return dict.__getitem__(self, key)
+            entry = self.pending.get(key)
+        if entry is None:
+            raise KeyError(key)
+        load_module_to_registry(*entry)
+        return dict.__getitem__(self, key)
+
+
 # This dictionary will hold references to all loaded modules, shared globally
-module_registry = {}
+module_registry = ModuleRegistry()
+_background_modules = []
+
+
+def _boot_print(message, color):
+    # We load ANSI first to use its colors
+    if 'ansi' in module_registry:
+        ansi_colors = dict.__getitem__(module_registry, 'ansi').ansi
+        print(f"{ansi_colors[color]}{message}{ansi_colors['reset']}")
+    else:
+        # Fallback print if ansi isn't loaded yet
+        print(message)
 
 
 # --- Helper Function for Dynamic Loading ---
-def load_module_to_registry(module_path: str, important: bool):
+def load_module_to_registry(module_path: str, important: bool, lazy = False, background = False):
     """
     Dynamically loads a module using standard Python import mechanism
     and stores it in the shared module_registry dictionary.
+    lazy defers the import to the first registry lookup, background hands it to the boot thread.
     """
     module_short_name = module_path.split('.')[-1]
 
-    # We load ANSI first to use its colors
-    if 'ansi' in module_registry:
-        print(
-            f"{module_registry['ansi'].ansi['green']}--Loading {module_path} as {module_short_name}{module_registry['ansi'].ansi['reset']}")
-    else:
-        # Fallback print if ansi isn't loaded yet
-        print(f"--Loading {module_path} as {module_short_name}")
+    if lazy or background:
+        module_registry.pending[module_short_name] = (module_path, important)
+        if background:
+            _background_modules.append(module_short_name)
+        return
 
     try:
         # Manually import the module. Python caches this automatically.
+        started = _boot_clock.perf_counter()
         __import__(module_path)
         loaded_module = sys.modules[module_path]
 
         # Store the module object reference in our central dictionary
-        module_registry[module_short_name] = loaded_module
+        with module_registry.lock:
+            module_registry[module_short_name] = loaded_module
+            module_registry.pending.pop(module_short_name, None)
+        if module_short_name not in module_registry.boot_times:
+            module_registry.boot_times[module_short_name] = _boot_clock.perf_counter() - started
 
-        if 'ansi' in module_registry:
-            print(
-                f"{module_registry['ansi'].ansi['green']}--Successfully registered {module_short_name}{module_registry['ansi'].ansi['reset']}")
-        else:
-            print(
-                f"--Successfully registered {module_short_name}")
+        if VERBOSE_BOOT:
+            _boot_print(f"--Registered {module_path} as {module_short_name} ({module_registry.boot_times[module_short_name] * 1000:.1f} ms)", 'green')
 
     except ImportError as e:
+        with module_registry.lock:
+            module_registry.pending.pop(module_short_name, None)
         if important:
-            if 'ansi' in module_registry:
-                print(
-                    f"{module_registry['ansi'].ansi['red']}KERNEL PANIC: Module '{module_path}' failed to load. Halting. ({e}){module_registry['ansi'].ansi['reset']}")
-            else:
-                print(f"KERNEL PANIC: Module '{module_path}' failed to load. Halting. ({e})")
+            _boot_print(f"KERNEL PANIC: Module '{module_path}' failed to load. Halting. ({e})", 'red')
+            if _thread.get_ident() != _main_thread:
+                # Background and lazy modules load on whichever thread gets to them first, quit() would only end that one
+                sys.stdout.flush()
+                _os._exit(1)
             quit()
         else:
-            if 'ansi' in module_registry:
-                print(f"{module_registry['ansi'].ansi['yellow']}Module '{module_path}' failed to load, but is not required. This may cause issues later. ({e}){module_registry['ansi'].ansi['reset']}")
-            else:
-                print(f"Module '{module_path}' failed to load, but is not required. This may cause issues later. ({e})")
+            _boot_print(f"Module '{module_path}' failed to load, but is not required. This may cause issues later. ({e})", 'yellow')
+
+
+def _load_background_modules():
+    for module_short_name in _background_modules:
+        entry = module_registry.pending.get(module_short_name)
+        if entry is not None:
+            load_module_to_registry(*entry)
 
 # --- OS Startup Logic ---
 
@@ -64,26 +116,38 @@ import builtins
 builtins.__elaptic_registry__ = module_registry
 
 # Load modules
+# Only what the shell prompt needs is imported right away. The heavy modules for running
+# programs load in the background while the prompt comes up, and the desktop loads on first use.
 load_module_to_registry("kernel.modules.ansi", True)
 load_module_to_registry("sys", True)
 load_module_to_registry("os", False)
-load_module_to_registry("re", True)
-load_module_to_registry("select", False)
+load_module_to_registry("re", True, lazy=True)
+load_module_to_registry("select", False, lazy=True)
 load_module_to_registry("builtins", True)
 load_module_to_registry("_thread", False)
-load_module_to_registry("asyncio", True)
+load_module_to_registry("asyncio", True, background=True)
 load_module_to_registry("time", True)
+load_module_to_registry("kernel.modules.trace", True)
+load_module_to_registry("kernel.modules.console", True)
 load_module_to_registry("kernel.modules.keyboard", True)
+load_module_to_registry("kernel.modules.diskimage", True)
+load_module_to_registry("kernel.modules.vfs", True)
 load_module_to_registry("kernel.modules.api", True)
-load_module_to_registry("kernel.modules.pixel", False)
+load_module_to_registry("kernel.modules.pixel", False, lazy=True)
 load_module_to_registry("kernel.modules.interpreter", True)
-load_module_to_registry("kernel.ede", False)
+load_module_to_registry("kernel.modules.procpool", True, background=True)
+load_module_to_registry("kernel.modules.compositor", False, lazy=True)
+load_module_to_registry("kernel.modules.scheduler", True, background=True)
+load_module_to_registry("kernel.ede", False, lazy=True)
 load_module_to_registry("kernel.modules.shellwrapper", True)
 
+# Boot from a disk image instead of the fs/ directory: python main.py --image fs.img
+if "--image" in sys.argv[1:-1]:
+    vfs = module_registry['vfs']
+    vfs.mount("/", vfs.ImageBackend(sys.argv[sys.argv.index("--image") + 1]))
+
 # Set variable names to module
 ansi = module_registry['ansi']
-asyncio = module_registry['asyncio']
-ede = module_registry['ede']
 time = module_registry['time']
 sys = module_registry['sys']
 interpreter = module_registry['interpreter']
@@ -91,23 +155,44 @@ shellwrapper = module_registry['shellwrapper']
 keyboard = module_registry['keyboard']
 environment = sys.implementation.name
 
+if VERBOSE_BOOT:
+    print(f"Kernel ready in {(_boot_clock.perf_counter() - _boot_started) * 1000:.1f} ms, {len(module_registry.pending)} modules still pending")
 print("\n\n\n")
 
 # --------KERNEL SYSTEM--------
 def mainloop():
-    while True:
-        time.sleep(3)
+    _load_background_modules()
+    module_registry['procpool'].prefork() # fork program workers before anything else is using this thread
+    # The kernel event loop, programs with top-level await run on it as tasks
+    module_registry['scheduler'].run()
 
 def shell_interface(start_command = ""):
     if start_command != "":
         shellwrapper.run_shell_command(start_command)
     print(f"--------ElapticOS Version {kernel_version} running under '{environment}'--------")
+    module_registry.prompt_ready = _boot_clock.perf_counter()
     while True:
         keyboard.stop_keyboard_monitoring() #make sure keyboard monitoring doesn't interact with inputs
-        command = input("$> ")
+        try:
+            command = input("$> ")
+        except EOFError: # ctrl-d
+            print()
+            return
         shellwrapper.run_shell_command(command)
 
+def batch_interface(lines):
+    """No prompts and no terminal setup, just runs the commands and returns once they are done."""
+    module_registry.prompt_ready = _boot_clock.perf_counter()
+    shellwrapper.run_batch(lines)
+
 
 # Start the kernel :D
 _thread.start_new_thread(mainloop, ())
-shell_interface() #start with ede
+# Commands from a file (python main.py --script cmds.txt) or a pipe run in batch mode
+if "--script" in sys.argv[1:-1]:
+    with open(sys.argv[sys.argv.index("--script") + 1]) as script_file:
+        batch_interface(script_file)
+elif not sys.stdin.isatty():
+    batch_interface(sys.stdin)
+else:
+    shell_interface() #start with ede
@@ -1,6 +1,8 @@
 # WARNING: USER PROGRAMS CAN ACCESS ANYTHING IMPORTED HERE, FIX ASAP
 # TODO: confirm if fixed ^
 
+_traced = __elaptic_registry__['trace'].traced # underscore, so worker programs can't call it through their api proxy (tasks and the shell get this module itself, so it's still in reach there, like the rest of this file)
+
 dump_to_ede = True # Flag for programs to exit back to ede, if false it goes to the shell. should default to go back to ede
 
 def lastkey(reset = False):
@@ -10,19 +12,79 @@ def lastkey(reset = False):
         keyboard.last_key = ""
     return last_key
 
+@_traced("api")
 def touch(path: str):
-    with open(f"fs/{path}", "w") as f:
-        pass
+    vfs = __elaptic_registry__['vfs']
+    vfs.write(path, b"")
     return True
 
+@_traced("api")
 def rm(path: str):
-    os = __elaptic_registry__['os']
+    vfs = __elaptic_registry__['vfs']
     try:
-        os.remove(f"fs/{path}")
+        vfs.remove(path)
         return True
     except:
         return False
 
+@_traced("api")
+def read(path: str, binary = False):
+    """Returns a file's contents, as bytes if binary is set. Repeated reads come from the page cache."""
+    vfs = __elaptic_registry__['vfs']
+    data = vfs.read(path)
+    return data if binary else data.decode("utf-8")
+
+@_traced("api")
+def write(path: str, data, append = False):
+    """Writes a str or bytes to a file, replacing it unless append is set."""
+    vfs = __elaptic_registry__['vfs']
+    vfs.write(path, data, append)
+    return True
+
+@_traced("api")
+def listdir(path: str = "/"):
+    vfs = __elaptic_registry__['vfs']
+    return vfs.listdir(path)
+
 def sleep(amount: int):
     time = __elaptic_registry__['time']
-    time.sleep(amount)
\ No newline at end of file
+    time.sleep(amount)
+
+# Awaitable versions for programs that run as tasks (top-level await), they let other tasks run meanwhile
+
+async def async_sleep(amount: float):
+    asyncio = __elaptic_registry__['asyncio']
+    await asyncio.sleep(amount)
+
+async def async_lastkey(timeout = None):
+    """Waits for the next key press and returns it, or the last key if nothing was pressed within timeout seconds."""
+    scheduler = __elaptic_registry__['scheduler']
+    return await scheduler.next_key(timeout)
+
+# Windows on the desktop (see compositor.py). Sizes and positions are in pixels, colors are 0xRRGGBB.
+# Drawing shows up on the desktop's next frame, or when it's opened next if it isn't up right now.
+
+@_traced("api")
+def open_window(width: int, height: int, title: str = ""):
+    """Opens a window for this program and returns its id, it closes when the program ends."""
+    return __elaptic_registry__['compositor'].open_window(width, height, title)
+
+@_traced("api")
+def draw_pixels(window: int, x: int, y: int, width: int, height: int, pixels):
+    """Copies a width x height block of pixels (a list or array of colors, row by row) into a window at (x, y)."""
+    __elaptic_registry__['compositor'].draw_pixels(window, x, y, width, height, pixels)
+    return True
+
+@_traced("api")
+def fill_window(window: int, color: int, x: int = 0, y: int = 0, width: int = None, height: int = None):
+    """Fills a rectangle of a window, the whole window if no rectangle is given."""
+    __elaptic_registry__['compositor'].fill_window(window, color, x, y, width, height)
+    return True
+
+def window_key(window: int):
+    """The next key typed into the window while it had focus (tab on the desktop), None if there is none."""
+    return __elaptic_registry__['compositor'].window_key(window)
+
+def close_window(window: int):
+    __elaptic_registry__['compositor'].close_window(window)
+    return True
\ No newline at end of file
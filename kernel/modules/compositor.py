@@ -0,0 +1,264 @@
+# --------COMPOSITOR--------
+# Windows for programs. A program opens one with api.open_window() and draws into it with the other
+# window calls in api, from a worker process as well. Every window is a pixel.Surface (an offscreen
+# framebuffer that keeps its pixels) with a border around it. Drawing happens on the program's thread
+# and only collects the changed area, the desktop picks the changes up once per loop in sync(). So only
+# windows that changed or moved get recomposited, and only their character rows get encoded again,
+# everything else comes out of the screen's cell cache.
+# Windows live here and not in ede, programs can open and draw on them while the desktop isn't up and
+# they show up the next time it is. A window closes with the program that opened it.
+
+pixel = __elaptic_registry__['pixel']
+keyboard = __elaptic_registry__['keyboard']
+procpool = __elaptic_registry__['procpool']
+import threading
+import collections
+from array import array
+
+MAX_WINDOWS = 16
+MAX_WINDOW_SIZE = 256  # pixels per side
+BORDER_COLOR = 0x5a5a5a
+FOCUS_COLOR = 0x00ff11  # same green as the desktop's selector
+WINDOW_Z = 10  # windows stack above the desktop's icons and selector
+KEY_QUEUE_SIZE = 64  # keys typed into a window that its program hasn't read yet
+
+windows = {}  # id -> Window, in the order they were opened
+focused = None  # the Window getting keys, None while the desktop has them
+lock = threading.Lock()  # programs draw from their own threads, the desktop renders from another
+_screen = None  # the desktop's Screen while it is up
+_removed = []  # closed windows the desktop still has to take off its screen
+_changed = False  # something changed since the desktop last synced, it has been woken up already
+_next_id = 1
+_next_z = WINDOW_Z
+
+
+def _border_pixels(width, height, color):
+    # A one pixel frame around a width x height window, transparent inside
+    pixels = array('I', [0]) * ((width + 2) * (height + 2))
+    for x in range(width + 2):
+        pixels[x] = color
+        pixels[(height + 1) * (width + 2) + x] = color
+    for y in range(1, height + 1):
+        pixels[y * (width + 2)] = color
+        pixels[y * (width + 2) + width + 1] = color
+    return pixels
+
+
+class Window:
+    def __init__(self, window_id, owner, width, height, title):
+        self.id = window_id
+        self.owner = owner  # the Program that opened it, None for the shell
+        self.title = title
+        self.surface = pixel.Surface(width, height)
+        self.border = pixel.Bitmap(width + 2, height + 2, _border_pixels(width, height, BORDER_COLOR))
+        self.keys = collections.deque(maxlen=KEY_QUEUE_SIZE)
+        self.placed = False  # gets a spot the first time it goes on a screen
+
+    def bounds(self):
+        return self.border.bounds()
+
+    def set_position(self, x, y):
+        self.border.set_position(x, y)
+        self.surface.set_position(x + 1, y + 1)
+
+    def move(self, dx, dy):
+        self.set_position(self.border.x + dx, self.border.y + dy)
+
+    def set_z(self, z):
+        self.border.set_z(z)
+        self.surface.set_z(z + 1)
+
+    def set_border(self, color):
+        self.border.pixels = _border_pixels(self.surface.width, self.surface.height, color)
+        self.border.update_mask()
+
+
+def _mark_changed():
+    # Callers hold lock
+    global _changed
+    if _screen is not None and not _changed:
+        _changed = True
+        keyboard.wake()  # the desktop may be waiting for a key with nothing to draw
+
+
+def _get(window_id):
+    # Callers hold lock. Programs can only touch their own windows, the shell can touch any.
+    window = windows.get(window_id)
+    caller = procpool.current_program.get()
+    if window is None or (caller is not None and window.owner is not caller):
+        raise ValueError(f"no window {window_id}")
+    return window
+
+
+def _reap():
+    # Callers hold lock
+    for window in list(windows.values()):
+        if window.owner is not None and window.owner.done.is_set():
+            _close(window)
+
+
+def _close(window):
+    # Callers hold lock
+    global focused
+    del windows[window.id]
+    _removed.append(window)
+    if focused is window:
+        focused = None
+    _mark_changed()
+
+
+def open_window(width, height, title=""):
+    """Opens a width x height pixel window for the calling program and returns its id."""
+    global _next_id
+    if not (0 < width <= MAX_WINDOW_SIZE and 0 < height <= MAX_WINDOW_SIZE):
+        raise ValueError(f"windows are 1 to {MAX_WINDOW_SIZE} pixels per side")
+    with lock:
+        _reap()
+        if len(windows) >= MAX_WINDOWS:
+            raise ValueError(f"too many windows open (at most {MAX_WINDOWS})")
+        window = Window(_next_id, procpool.current_program.get(), width, height, str(title))
+        _next_id += 1
+        windows[window.id] = window
+        _mark_changed()
+    return window.id
+
+
+def close_window(window_id):
+    with lock:
+        _close(_get(window_id))
+
+
+def fill_window(window_id, color, x=0, y=0, width=None, height=None):
+    with lock:
+        window = _get(window_id)
+        window.surface.fill(color, x, y, width, height)
+        _mark_changed()
+
+
+def draw_pixels(window_id, x, y, width, height, pixels):
+    with lock:
+        window = _get(window_id)
+        window.surface.blit(x, y, width, height, pixels)
+        _mark_changed()
+
+
+def window_key(window_id):
+    """The oldest key typed into the window while it had focus, or None."""
+    with lock:
+        keys = _get(window_id).keys
+        return keys.popleft() if keys else None
+
+
+def _place(window, screen):
+    # First spot from the top right where the window doesn't cover another one, otherwise cascade
+    width = window.surface.width + 2
+    height = window.surface.height + 2
+    taken = [other.bounds() for other in windows.values() if other.placed and other is not window]
+    for y in range(0, screen.height_pixels - height + 1, 2):
+        for x in range(screen.width_pixels - width, -1, -1):
+            if all(x + width <= ox0 or ox1 <= x or y + height <= oy0 or oy1 <= y for ox0, oy0, ox1, oy1 in taken):
+                window.set_position(x, y)
+                return
+    offset = 2 * (len(taken) % 8)
+    window.set_position(offset, offset)
+
+
+def _attach(window, screen):
+    global _next_z
+    if not window.placed:
+        _place(window, screen)
+        window.placed = True
+    window.set_z(_next_z)
+    _next_z += 2
+    screen.add_sprite(window.border)
+    screen.add_sprite(window.surface)
+    window.surface.damage = None  # it gets drawn whole anyway
+
+
+def attach(screen):
+    """The desktop came up, puts every window on its screen."""
+    global _screen, _changed
+    with lock:
+        _screen = screen
+        _changed = False
+        _removed.clear()
+        for window in windows.values():
+            _attach(window, screen)
+
+
+def detach():
+    """The desktop is going away, windows keep their pixels and position for next time."""
+    global _screen, focused
+    with lock:
+        if _screen is None:
+            return
+        for window in windows.values():
+            _screen.remove_sprite(window.border)
+            _screen.remove_sprite(window.surface)
+        _removed.clear()
+        if focused is not None:
+            focused.set_border(BORDER_COLOR)
+            focused = None
+        _screen = None
+
+
+def sync():
+    """
+    Desktop side, once per loop: puts new windows on the screen, takes closed ones (and those of programs that
+    finished) off, and marks what programs drew since the last call dirty. Returns True if anything changed.
+    """
+    global _changed
+    with lock:
+        _reap()  # finishing doesn't wake the desktop, so this looks every time
+        if not _changed:
+            return False
+        _changed = False
+        for window in _removed:
+            _screen.remove_sprite(window.border)
+            _screen.remove_sprite(window.surface)
+        _removed.clear()
+        for window in windows.values():
+            if window.surface.screen is None:
+                _attach(window, _screen)
+            else:
+                window.surface.present()
+        return True
+
+
+def focus_next():
+    """Gives the next window (in the order they were opened) the keys and brings it to the front, after the last one the desktop gets them back."""
+    global focused, _next_z
+    with lock:
+        order = list(windows.values())
+        if focused is not None:
+            focused.set_border(BORDER_COLOR)
+            index = order.index(focused) + 1 if focused in order else len(order)
+            focused = order[index] if index < len(order) else None
+        else:
+            focused = order[0] if order else None
+        if focused is not None:
+            focused.set_border(FOCUS_COLOR)
+            focused.set_z(_next_z)
+            _next_z += 2
+        return focused
+
+
+def unfocus():
+    global focused
+    with lock:
+        if focused is not None:
+            focused.set_border(BORDER_COLOR)
+            focused = None
+
+
+def move_focused(dx, dy):
+    with lock:
+        if focused is not None:
+            focused.move(dx, dy)
+
+
+def send_key(key):
+    """Queues a key for the focused window's program."""
+    with lock:
+        if focused is not None:
+            focused.keys.append(key)
@@ -0,0 +1,197 @@
+# --------CONSOLE--------
+# Program output goes through here instead of straight to the terminal. Every program (by pid)
+# gets its own buffer, and a flusher thread writes all of them out together at most once every
+# FLUSH_INTERVAL, in a single os.write. So a chatty program costs one write syscall per interval
+# instead of one per print, and output of two programs never gets mixed up mid-print.
+# While the desktop is up (hold()) program output stays buffered, so it can't tear a frame. Frames
+# themselves go out through a FrameOutput, one os.write per frame.
+# A program whose buffer is full either waits for it to drain (workers, see procpool) or loses its
+# oldest output (tasks, they can't block the event loop everyone shares).
+
+os = __elaptic_registry__['os']
+sys = __elaptic_registry__['sys']
+time = __elaptic_registry__['time']
+trace = __elaptic_registry__['trace']
+import threading
+import collections
+
+FLUSH_INTERVAL = 1 / 60  # seconds output may wait so it can go out together with more
+BUFFER_SIZE = 64 * 1024  # bytes a program may have waiting before it has to wait or loses old output
+fd = None  # where output goes, None is the kernel's stdout
+
+writes = 0  # os.write calls so far, compare with trace's console.prints
+bytes_written = 0
+
+
+class _Channel:
+    __slots__ = ("chunks", "size", "dropped", "closed")
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0  # bytes thrown away to make room since the last flush
+        self.closed = False
+
+
+channels = {}  # pid -> _Channel
+_lock = threading.Lock()
+_changed = threading.Condition(_lock)  # buffers filled up or drained, or the desktop let go
+_write_lock = threading.Lock()  # one flush at a time, so output keeps its order
+_held = 0
+_flusher = None
+
+
+def _output_fd():
+    if fd is not None:
+        return fd
+    if sys.__stdout__ is None:
+        return None
+    try:
+        return sys.__stdout__.fileno()
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _write(data):
+    # Callers hold _write_lock
+    global writes, bytes_written
+    target = _output_fd()
+    if target is None:
+        return
+    if fd is None:
+        sys.__stdout__.flush()  # whatever the shell printed comes first
+    view = memoryview(data)
+    while view:
+        view = view[os.write(target, view):]
+    writes += 1
+    bytes_written += len(data)
+    trace.count("console.writes")
+    trace.count("console.bytes", len(data))
+
+
+def _has_output():
+    # Callers hold _lock
+    return not _held and any(channel.size or channel.dropped for channel in channels.values())
+
+
+def _flush_loop():
+    while True:
+        with _lock:
+            _changed.wait_for(_has_output)
+        time.sleep(FLUSH_INTERVAL)  # let more output pile up, it all goes out in one write
+        flush()
+
+
+def write(name, text, block=True, timeout=None):
+    """
+    Queues text (str or bytes) for the terminal under name. If name's buffer is full, with block this waits
+    until there's room (up to timeout seconds, then returns False without queueing anything), without block
+    the oldest queued output is dropped to make room.
+    """
+    global _flusher
+    data = text.encode("utf-8", "replace") if isinstance(text, str) else bytes(text)
+    if not data:
+        return True
+    trace.count("console.prints")
+    with _lock:
+        channel = channels.get(name)
+        if channel is None:
+            channel = channels[name] = _Channel()
+        # A single write bigger than the buffer still goes in once the buffer is empty
+        if block and not _changed.wait_for(lambda: channel.size == 0 or channel.size + len(data) <= BUFFER_SIZE, timeout):
+            return False
+        channel.chunks.append(data)
+        channel.size += len(data)
+        while channel.size > BUFFER_SIZE and len(channel.chunks) > 1:
+            dropped = channel.chunks.popleft()
+            channel.size -= len(dropped)
+            channel.dropped += len(dropped)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, daemon=True)
+            _flusher.start()
+        _changed.notify_all()
+    return True
+
+
+def flush():
+    """Writes everything queued out right away (in one os.write), unless the desktop holds the terminal."""
+    with _write_lock:
+        with _lock:
+            if _held:
+                return
+            parts = []
+            for name, channel in list(channels.items()):
+                if channel.dropped:
+                    parts.append(f"[{channel.dropped} bytes of output dropped]\n".encode())
+                    channel.dropped = 0
+                parts.extend(channel.chunks)
+                channel.chunks.clear()
+                channel.size = 0
+                if channel.closed:
+                    del channels[name]
+            _changed.notify_all()  # writers waiting for room
+        if parts:
+            _write(b"".join(parts))
+
+
+def close(name):
+    """The program behind name is done, writes out what it left and forgets its buffer."""
+    with _lock:
+        channel = channels.get(name)
+        if channel is None:
+            return
+        channel.closed = True
+    flush()
+
+
+def hold():
+    """Keeps program output buffered until release(), the desktop calls this while it owns the terminal."""
+    global _held
+    with _lock:
+        _held += 1
+
+
+def release():
+    global _held
+    with _lock:
+        _held -= 1
+        _changed.notify_all()
+    flush()
+
+
+class Stream:
+    """File-like handle on one buffer, e.g. the stdout of a task."""
+    def __init__(self, name, block=True):
+        self.name = name
+        self.block = block
+
+    def write(self, text):
+        write(self.name, text, self.block)
+        return len(text)
+
+    def flush(self):
+        pass  # the flusher thread is never more than FLUSH_INTERVAL away
+
+    def isatty(self):
+        return False
+
+
+class FrameOutput:
+    """File-like frame output for ede: everything written between two flush() calls reaches the terminal in one os.write."""
+    def __init__(self):
+        self._parts = []
+
+    def write(self, text):
+        self._parts.append(text)
+        return len(text)
+
+    def flush(self):
+        if not self._parts:
+            return
+        data = "".join(self._parts).encode("utf-8")
+        self._parts.clear()
+        with _write_lock:
+            _write(data)
+
+    def isatty(self):
+        return sys.__stdout__ is not None and sys.__stdout__.isatty()
@@ -0,0 +1,139 @@
+# --------DISK IMAGES--------
+# A whole ElapticOS filesystem packed into one file: a header, the file contents as extents,
+# and a directory index. Images are opened with mmap, lookups go through the index and file
+# contents come back as memoryviews straight out of the mapping, without copying.
+#
+# This module doesn't need the kernel, so it doubles as the pack/unpack tool:
+#     python -m kernel.modules.diskimage pack fs fs.img
+#     python -m kernel.modules.diskimage unpack fs.img fs
+#     python -m kernel.modules.diskimage list fs.img
+# Boot from an image with: python main.py --image fs.img
+#
+# Image layout (little endian):
+#     header: b"EFS1", version (H), file count (I), index offset (Q)
+#     data:   file contents, back to back
+#     index:  per file: path length (H), mtime_ns (q), data offset (Q), size (Q), path (utf-8)
+# Paths are absolute inside the image ("/programs/program1.py").
+
+import os
+import sys
+import mmap
+import struct
+
+MAGIC = b"EFS1"
+VERSION = 1
+_HEADER = struct.Struct("<4sHIQ")
+_ENTRY = struct.Struct("<HqQQ")
+
+
+class DiskImage:
+    """A read-only, memory-mapped image."""
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.entries = {}  # path -> (offset, size, mtime_ns)
+        self.directories = {"/"}
+        with open(image_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self.data = memoryview(b"")  # mmap can't map empty files
+                return
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self._map)
+
+        magic, version, count, index_offset = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{image_path} is not an ElapticOS image")
+        position = index_offset
+        for _ in range(count):
+            path_length, mtime_ns, offset, size = _ENTRY.unpack_from(self.data, position)
+            position += _ENTRY.size
+            path = bytes(self.data[position:position + path_length]).decode("utf-8")
+            position += path_length
+            self.entries[path] = (offset, size, mtime_ns)
+            # Remember every parent directory so stat/listdir don't have to search
+            parent = path.rsplit("/", 1)[0] or "/"
+            while parent not in self.directories:
+                self.directories.add(parent)
+                parent = parent.rsplit("/", 1)[0] or "/"
+
+    def view(self, path):
+        """Returns a file's contents as a memoryview into the mapping (no copy), raises KeyError if missing."""
+        offset, size, _ = self.entries[path]
+        return self.data[offset:offset + size]
+
+    def listdir(self, path):
+        prefix = path.rstrip("/") + "/"
+        names = set()
+        for name in list(self.entries) + list(self.directories):
+            if name != path and name.startswith(prefix):
+                names.add(name[len(prefix):].split("/")[0])
+        return names
+
+
+def pack(image_path, files):
+    """Writes files ({absolute path: (bytes-like, mtime_ns)}) as an image, replacing image_path atomically."""
+    chunks = [b""]  # header goes here once we know where the index starts
+    index = []
+    offset = _HEADER.size
+    for path in sorted(files):
+        data, mtime_ns = files[path]
+        encoded_path = path.encode("utf-8")
+        index.append(_ENTRY.pack(len(encoded_path), mtime_ns, offset, len(data)) + encoded_path)
+        chunks.append(data)
+        offset += len(data)
+    chunks[0] = _HEADER.pack(MAGIC, VERSION, len(index), offset)
+    chunks.extend(index)
+    with open(image_path + ".tmp", "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(image_path + ".tmp", image_path)
+
+
+def pack_directory(directory, image_path):
+    """Packs every file under a host directory into an image, returns the number of files."""
+    files = {}
+    for root, directories, filenames in os.walk(directory):
+        directories[:] = [name for name in directories if not name.startswith(".")]  # host-side caches like .pycache
+        for filename in filenames:
+            host_path = os.path.join(root, filename)
+            relative = os.path.relpath(host_path, directory).replace(os.sep, "/")
+            with open(host_path, "rb") as f:
+                files["/" + relative] = (f.read(), os.stat(host_path).st_mtime_ns)
+    pack(image_path, files)
+    return len(files)
+
+
+def _host_path(directory, path):
+    # Where an image path goes under directory. Images come from anywhere, so a path like
+    # "/../../.bashrc" (or one through a symlink in directory) must not get written outside it.
+    root = os.path.realpath(directory)
+    host_path = os.path.realpath(os.path.join(root, *path.strip("/").split("/")))
+    if host_path == root or os.path.commonpath([root, host_path]) != root:
+        raise ValueError(f"{path!r} would be extracted outside of {directory}")
+    return host_path
+
+
+def unpack(image_path, directory):
+    """Extracts every file of an image into a host directory, returns the number of files."""
+    image = DiskImage(image_path)
+    host_paths = {path: _host_path(directory, path) for path in image.entries}  # all of them, before writing anything
+    for path, (_, _, mtime_ns) in image.entries.items():
+        host_path = host_paths[path]
+        os.makedirs(os.path.dirname(host_path), exist_ok=True)
+        with open(host_path, "wb") as f:
+            f.write(image.view(path))
+        os.utime(host_path, ns=(mtime_ns, mtime_ns))
+    return len(image.entries)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "pack":
+        print(f"Packed {pack_directory(sys.argv[2], sys.argv[3])} files into {sys.argv[3]}")
+    elif len(sys.argv) == 4 and sys.argv[1] == "unpack":
+        print(f"Unpacked {unpack(sys.argv[2], sys.argv[3])} files into {sys.argv[3]}")
+    elif len(sys.argv) == 3 and sys.argv[1] == "list":
+        image = DiskImage(sys.argv[2])
+        for path, (offset, size, _) in sorted(image.entries.items()):
+            print(f"{size:>10}  {path}")
+    else:
+        print("usage: python -m kernel.modules.diskimage pack <directory> <image>")
+        print("       python -m kernel.modules.diskimage unpack <image> <directory>")
+        print("       python -m kernel.modules.diskimage list <image>")
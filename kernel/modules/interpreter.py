@@ -5,6 +5,15 @@ sys = __elaptic_registry__['sys']
 os = __elaptic_registry__['os']
 
 api = __elaptic_registry__['api']
+trace = __elaptic_registry__['trace']
+import ast
+import inspect
+import hashlib
+import marshal
+import importlib.util
+import types
+import weakref
+from collections import OrderedDict
 
 
 # --- The Sandbox Environment Setup ---
@@ -14,7 +23,8 @@ def _create_secure_execution_env(): # Only whitelisted builtins are allowed
     whitelist_builtins = [
         'print', 'len', 'range', 'list', 'dict', 'tuple', 'str', 'int', 'float',
         'bool', 'type', 'isinstance', 'KeyError', 'ValueError', 'TypeError', 'Exception',
-        'asyncio',  # We allow asyncio functions for task management
+        # No 'asyncio' here, it would hand out subprocesses and sockets. Programs get
+        # awaitables through api (api.async_sleep, api.async_lastkey) instead.
     ]
 
     safe_builtins = {}
@@ -35,8 +45,194 @@ def _create_secure_execution_env(): # Only whitelisted builtins are allowed
 # Initialize the secure environment once when this module loads
 _GLOBAL_SECURE_SCOPE = _create_secure_execution_env()
 
-# A persistent local scope to maintain variables across shell commands
-_SESSION_LOCAL_SCOPE = {}
+# The session: variables set at the shell, next to the sandbox's builtins and api. Shell one-liners
+# run straight in it. Scripts get a plain globals dict of their own holding their api (and print)
+# plus the session variables their code mentions, and whatever they assign lands there too. So
+# launching a script copies only the names it uses however big the session is, scripts running at
+# the same time don't see each other's variables, functions a script defines see the same api and
+# print as its top level, and what a script set is merged into the session when it finishes.
+# (A plain dict and not one falling back to the session with __missing__: that takes global
+# lookups off CPython's fast path, global heavy loops ran almost twice as slow.)
+_SESSION_SCOPE = dict(_GLOBAL_SECURE_SCOPE)
+
+_UNSET = object()
+_names_cache = weakref.WeakKeyDictionary()  # code object -> names it and the code in it may look up
+
+
+def _global_names(code):
+    names = _names_cache.get(code)
+    if names is None:
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):  # functions and classes defined in the script
+                names |= _global_names(const)
+        names = _names_cache[code] = frozenset(names)
+    return names
+
+
+def _run_scope(code, api_object=None, print_function=None):
+    scope = {'__builtins__': _GLOBAL_SECURE_SCOPE['__builtins__']}
+    for name in _global_names(code):
+        value = _SESSION_SCOPE.get(name, _UNSET)
+        if value is not _UNSET:
+            scope[name] = value
+    scope['api'] = api if api_object is None else api_object
+    if print_function is not None:
+        scope['print'] = print_function
+    return scope, dict(scope)
+
+
+def merge_scope(local_scope):
+    """Puts what a script assigned into the session, costs as much as the names it set."""
+    _SESSION_SCOPE.update(local_scope)
+
+
+def _merge_run_scope(scope, seeded):
+    # Only the names the script set, not the session variables and api it was handed
+    merge_scope({name: value for name, value in scope.items() if seeded.get(name, _UNSET) is not value})
+
+
+# --- Compile Cache ---
+# Code objects keyed by a hash of their source, so relaunching a program or repeating a
+# shell one-liner skips parsing and compiling. Scripts are also marshalled to disk so
+# the cache survives reboots; set BYTECODE_CACHE_DIR to None to keep it in memory only.
+# The store is outside of fs/ on purpose: programs can write anything under the vfs root,
+# and a code object they planted there would run as someone else's program.
+
+COMPILE_CACHE_SIZE = 256
+BYTECODE_CACHE_DIR = ".pycache"
+BYTECODE_CACHE_LIMIT = 1024  # files in the store, the least recently used ones go first
+_compile_cache = OrderedDict()
+_on_disk = set()  # keys in _compile_cache that are in the store as well
+_compile_lock = __elaptic_registry__['_thread'].allocate_lock()
+
+
+def _load_code(key):
+    path = os.path.join(BYTECODE_CACHE_DIR, f"{key}.bin")
+    try:
+        with open(path, "rb") as f:
+            code = marshal.load(f)
+        os.utime(path)  # recently used, see _trim_store
+        return code
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _store_code(key, code):
+    path = os.path.join(BYTECODE_CACHE_DIR, f"{key}.bin")
+    try:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            marshal.dump(code, f)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        return False  # the memory cache still works if the store is read-only
+    _trim_store()
+    return True
+
+
+def _trim_store():
+    # Keeps the store at BYTECODE_CACHE_LIMIT files, only runs when something new was compiled
+    try:
+        names = [name for name in os.listdir(BYTECODE_CACHE_DIR) if name.endswith(".bin")]
+    except OSError:
+        return
+    if len(names) <= BYTECODE_CACHE_LIMIT:
+        return
+    entries = []
+    for name in names:
+        path = os.path.join(BYTECODE_CACHE_DIR, name)
+        try:
+            entries.append((os.stat(path).st_mtime_ns, path))
+        except OSError:
+            pass  # someone else trimmed it already
+    entries.sort()
+    for _, path in entries[:len(entries) - BYTECODE_CACHE_LIMIT]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def compile_cached(source: str, filename="<elaptic>", persist=False, flags=0):
+    """
+    Returns a code object for source, compiling it only if it isn't cached yet.
+    persist also keeps it in the on-disk store so it survives a reboot.
+    """
+    # The interpreter's magic number is part of the key, marshal data is version specific
+    key = hashlib.sha1(importlib.util.MAGIC_NUMBER + f"{filename}\0{flags}\0".encode() + source.encode()).hexdigest()
+
+    persist = persist and BYTECODE_CACHE_DIR is not None
+    with _compile_lock:
+        code = _compile_cache.get(key)
+        if code is not None:
+            _compile_cache.move_to_end(key)
+            if not persist or key in _on_disk:
+                return code
+
+    stored = False
+    if persist and code is None:
+        code = _load_code(key)
+        stored = code is not None
+    if code is None:
+        code = compile(source, filename, "exec", flags=flags)
+    if persist and not stored:
+        stored = _store_code(key, code)  # new, or compiled before without persist
+
+    with _compile_lock:
+        _compile_cache[key] = code
+        _compile_cache.move_to_end(key)
+        if stored:
+            _on_disk.add(key)
+        while len(_compile_cache) > COMPILE_CACHE_SIZE:
+            _on_disk.discard(_compile_cache.popitem(last=False)[0])
+    return code
+
+
+_traced_exec = trace.traced("interpreter", "exec")(exec)
+
+
+# --- Quotas ---
+# The kernel (procpool workers, scheduler tasks) meters programs with these and stops one that
+# goes over a quota by raising QuotaExceeded inside it, so it ends like any other script error.
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class OutputMeter:
+    """
+    Stands in for an output stream, counts the bytes written through it and raises QuotaExceeded past limit.
+    Without a stream it writes to whatever sys.stdout is at the time.
+    """
+    def __init__(self, stream=None, limit=None):
+        self._stream = stream
+        self.limit = limit
+        self.bytes = 0
+        self.exceeded = False
+
+    @property
+    def stream(self):
+        return sys.stdout if self._stream is None else self._stream
+
+    def write(self, text):
+        size = len(text.encode("utf-8", "replace"))
+        if self.limit is not None and self.bytes + size > self.limit:
+            self.exceeded = True
+            raise QuotaExceeded(f"output quota exceeded ({self.limit} bytes)")
+        self.bytes += size
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def print(self, *args, **kwargs):
+        """print() that goes through the meter, handed to scripts that share the kernel's stdout."""
+        kwargs["file"] = self
+        print(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 
 # --- 2. API Functions for Execution (Exposed to the Kernel/Shell) ---
@@ -44,31 +240,60 @@ _SESSION_LOCAL_SCOPE = {}
 def run_shell_command(command: str):
     """
     Executes a single line of Python code in the sandbox.
-    Uses exec() to allow variable assignment persistence in _SESSION_LOCAL_SCOPE.
+    Uses exec() to allow variable assignment persistence in _SESSION_SCOPE.
     """
     try:
         # Use exec for single lines, preserving local state
-        exec(command, _GLOBAL_SECURE_SCOPE, _SESSION_LOCAL_SCOPE)
+        _traced_exec(compile_cached(command, "<shell>"), _SESSION_SCOPE)
         return "Command executed."
     except Exception as e:
         # Return error message to the shell UI
         return f"Execution Error: {e}"
 
 
-def run_script(script_code: str):
+def run_script(script_code: str, api_object=None, merge=True):
     """
     Executes a multi-line Python script (e.g., from a file) in the sandbox.
-    Uses a fresh local scope for a cleaner execution boundary if needed,
-    or you can use the session local scope.
+    Reads shell vars from the session, its own assignments go to its own scope that gets
+    merged into the session if the script succeeds (and merge is set).
+    api_object replaces the 'api' the script sees (procpool workers pass a proxy).
     """
-    # Use the session scope here too to let scripts interact with shell vars
-    local_scope_for_script = _SESSION_LOCAL_SCOPE.copy()
-
     try:
+        code = compile_cached(script_code, "<script>", persist=True)
+        scope, seeded = _run_scope(code, api_object)
         # Use exec for multi-line scripts
-        exec(script_code, _GLOBAL_SECURE_SCOPE, local_scope_for_script)
-        # Update session locals after script finishes
-        _SESSION_LOCAL_SCOPE.update(local_scope_for_script)
+        _traced_exec(code, scope)
+        # Update the session after script finishes
+        if merge:
+            _merge_run_scope(scope, seeded)
+        return "Script executed successfully."
+    except Exception as e:
+        return f"Script Error: {e}"
+
+def is_async_script(script_code: str):
+    """True if the script uses await at the top level, those run as tasks on the kernel event loop."""
+    try:
+        # Not persisted, only scripts that turn out to be tasks go to the store (run_script_async does that)
+        code = compile_cached(script_code, "<task>", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+    except SyntaxError:
+        return False
+    return bool(code.co_flags & inspect.CO_COROUTINE)
+
+
+async def run_script_async(script_code: str, output=None):
+    """
+    Like run_script, but for scripts with top-level await. Must be awaited on the kernel
+    event loop; while the script awaits, other tasks get to run.
+    output (an OutputMeter) meters what the script prints, functions it defines included.
+    """
+    try:
+        code = compile_cached(script_code, "<task>", persist=True, flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+        scope, seeded = _run_scope(code, print_function=None if output is None else output.print)
+        # With top-level await allowed, eval hands back a coroutine instead of running the script
+        result = eval(code, scope)
+        if inspect.iscoroutine(result):
+            await result
+        _merge_run_scope(scope, seeded)
         return "Script executed successfully."
     except Exception as e:
         return f"Script Error: {e}"
@@ -76,5 +301,5 @@ def run_script(script_code: str):
 # If you want to allow users to see their current local variables:
 def get_session_variables():
     """Returns a dictionary of non-underscore session variables."""
-    return {k: v for k, v in _SESSION_LOCAL_SCOPE.items() if not k.startswith('_')}
+    return {k: v for k, v in _SESSION_SCOPE.items() if not k.startswith('_') and _GLOBAL_SECURE_SCOPE.get(k) is not v}
 
@@ -1,114 +1,348 @@
 import sys
+import os
 import time
 import select
+import codecs
 import _thread
+import threading
+from collections import deque, namedtuple
 
 # --- Global State ---
 last_key = "none"
 _lock = _thread.allocate_lock()
 _monitoring_active = False  # Added flag to control the thread
+_listener_stopped = threading.Event()  # set whenever no listener thread is running
+_listener_stopped.set()
+_stop_requested = threading.Event()  # wakes a scripted input source up when monitoring stops
+
+# Every key press becomes an event in a bounded queue so nothing gets lost between polls.
+# When the queue is full the oldest events are dropped.
+KeyEvent = namedtuple("KeyEvent", ["key", "time"])
+KEY_QUEUE_SIZE = 256
+_key_queue = deque(maxlen=KEY_QUEUE_SIZE)
+_key_available = threading.Condition(_lock)
+_key_listeners = []  # callbacks that get every KeyEvent, called from the listener thread
+_woken = False  # set by wake(), the next get_key(wakeable=True) returns right away
+
+# How long to wait for the rest of an escape sequence before treating ESC as its own key
+ESCAPE_TIMEOUT = 0.05
+
+# Scripted input that replaces the terminal, see use_input_source()
+_input_source = None
+_source_finished = False
 
 # --- Environment Specific Imports ---
 if sys.platform in ('linux', 'darwin'):
     import termios, tty
 
-    _fd = sys.stdin.fileno()
-    _old_settings = termios.tcgetattr(_fd)
+    try:
+        _fd = sys.stdin.fileno()
+        _old_settings = termios.tcgetattr(_fd)
+    except (AttributeError, ValueError, OSError, termios.error):
+        # stdin isn't a terminal (piped, CI), only scripted input works
+        _fd = None
+        _old_settings = None
+    terminal_attached = _old_settings is not None
+    # Writing to this pipe wakes the listener up so it can stop without a polling timeout
+    _wake_read, _wake_write = os.pipe()
 elif sys.platform == 'win32':
     import msvcrt
+    terminal_attached = sys.stdin is not None and sys.stdin.isatty()
+else:
+    terminal_attached = False
+
+# POSIX/ANSI escape sequences (without the leading ESC)
+_ESCAPE_NAMES = {
+    '[A': "UP",
+    '[B': "DOWN",
+    '[C': "RIGHT",
+    '[D': "LEFT",
+    'OA': "UP",
+    'OB': "DOWN",
+    'OC': "RIGHT",
+    'OD': "LEFT",
+    '[H': "HOME",
+    '[F': "END",
+    'OH': "HOME",
+    'OF': "END",
+    '[2~': "INSERT",
+    '[3~': "DELETE",
+    '[5~': "PAGEUP",
+    '[6~': "PAGEDOWN",
+}
+
+
+def _key_name(char):
+    # Windows Byte Sequence Mapping
+    if char == b'\xe0H':
+        return "UP"
+    elif char == b'\xe0P':
+        return "DOWN"
+    elif char == b'\xe0M':
+        return "RIGHT"
+    elif char == b'\xe0K':
+        return "LEFT"
+    elif char == b'\r':
+        return "ENTER"
+    # POSIX/ANSI String Mapping
+    elif char == '\x1b':
+        return "ESC"
+    elif isinstance(char, str) and char.startswith('\x1b') and char[1:] in _ESCAPE_NAMES:
+        return _ESCAPE_NAMES[char[1:]]
+    elif char in ('\r', '\n'):
+        return "ENTER"
+    try:
+        return char.decode('utf-8') if isinstance(char, bytes) else char
+    except:
+        return str(char)
+
+
+def split_keys(data):
+    """
+    Splits raw terminal input into one string per key press.
+    Returns (keys, leftover) where leftover is an escape sequence that hasn't fully arrived yet.
+    """
+    keys = []
+    i = 0
+    length = len(data)
+    while i < length:
+        if data[i] != '\x1b':
+            keys.append(data[i])
+            i += 1
+            continue
+
+        if i + 1 >= length:
+            return keys, data[i:]
+        if data[i + 1] == '[':
+            # CSI: parameter/intermediate bytes until a final byte in @..~
+            end = i + 2
+            while end < length and not ('\x40' <= data[end] <= '\x7e'):
+                end += 1
+            if end >= length:
+                return keys, data[i:]
+            keys.append(data[i:end + 1])
+            i = end + 1
+        elif data[i + 1] == 'O':
+            # SS3: exactly one more byte
+            if i + 2 >= length:
+                return keys, data[i:]
+            keys.append(data[i:i + 3])
+            i += 3
+        else:
+            keys.append('\x1b')
+            i += 1
+    return keys, ''
+
+
+def _log_error(message):
+    # stdout belongs to the shell and the desktop
+    if sys.__stderr__ is not None:
+        print(f"keyboard: {message}", file=sys.__stderr__, flush=True)
+
+
+def push_key(key_name, timestamp=None):
+    """Queues a key event and wakes up anyone waiting in get_key()."""
+    global last_key
+    event = KeyEvent(key_name, time.monotonic() if timestamp is None else timestamp)
+    with _key_available:
+        _key_queue.append(event)
+        last_key = key_name
+        _key_available.notify_all()
+    for listener in list(_key_listeners):
+        try:
+            listener(event)
+        except Exception as e:
+            # A broken listener must not take the listener thread (and every later key) down with it
+            _log_error(f"key listener {getattr(listener, '__qualname__', listener)} failed: {e!r}")
+
+
+def add_key_listener(callback):
+    """Calls callback(event) for every key press, without taking events out of the queue."""
+    _key_listeners.append(callback)
+
+
+def remove_key_listener(callback):
+    if callback in _key_listeners:
+        _key_listeners.remove(callback)
+
+
+def _read_posix():
+    """Blocks until input arrives (or we get woken up) and returns the keys read."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while _monitoring_active:
+        # Only wait for the rest of an escape sequence for a moment, otherwise block until something happens
+        timeout = ESCAPE_TIMEOUT if pending else None
+        rlist, _, _ = select.select([_fd, _wake_read], [], [], timeout)
+        if _wake_read in rlist:
+            os.read(_wake_read, 64)
+        if _fd in rlist:
+            data = os.read(_fd, 64)
+            if not data:
+                return  # stdin closed, select would report it readable forever
+            pending += decoder.decode(data)
+            keys, pending = split_keys(pending)
+        elif pending:
+            # The escape sequence never finished, hand out what we have as separate keys
+            keys = ['\x1b'] + split_keys(pending[1:])[0]
+            pending = ''
+        else:
+            continue
+        for key in keys:
+            yield key
+
+
+def _read_source(source):
+    """Hands out scripted keys, waiting between them when an item comes with a delay."""
+    global _source_finished
+    for item in source:
+        delay, key = item if isinstance(item, tuple) else (0, item)
+        if delay and _stop_requested.wait(delay):
+            return
+        if not _monitoring_active:
+            return
+        yield key
+    with _key_available:
+        _source_finished = True
+        _key_available.notify_all()  # nobody has to wait for keys that won't come
+
+
+def _read_windows():
+    # msvcrt can't be waited on, so windows still has to poll
+    while _monitoring_active:
+        if msvcrt.kbhit():
+            raw_char = msvcrt.getch()
+            if raw_char in (b'\x00', b'\xe0'):
+                raw_char += msvcrt.getch()
+            yield raw_char
+        else:
+            time.sleep(0.01)
 
 
 def _keyboard_listener_thread():
-    global last_key, _monitoring_active
+    global _monitoring_active
+    source = _input_source
+    raw_terminal = source is None and sys.platform in ('linux', 'darwin')
 
     # Set terminal to cbreak mode (non-canonical)
-    if sys.platform in ('linux', 'darwin'):
+    if raw_terminal:
         tty.setcbreak(_fd)
 
     try:
-        # Check the flag instead of 'True'
-        while _monitoring_active:
-            char = None
-
-            if sys.platform in ('linux', 'darwin'):
-                rlist, _, _ = select.select([sys.stdin], [], [], 0.1)  # Increased timeout slightly for efficiency
-                if rlist:
-                    char = sys.stdin.read(1)
-                    if char == '\x1b':
-                        char += sys.stdin.read(2)
-
-            elif sys.platform == 'win32':
-                if msvcrt.kbhit():
-                    raw_char = msvcrt.getch()
-                    if raw_char in (b'\x00', b'\xe0'):
-                        raw_char += msvcrt.getch()
-                    char = raw_char
-
-            else:
-                rlist, _, _ = select.select([sys.stdin], [], [], 0)
-                if rlist:
-                    char = sys.stdin.read(1)
-                    if char == '\x1b':
-                        char += sys.stdin.read(2)
-
-            if char:
-                key_name = None
-                # Windows Byte Sequence Mapping
-                if char == b'\xe0H':
-                    key_name = "UP"
-                elif char == b'\xe0P':
-                    key_name = "DOWN"
-                elif char == b'\xe0M':
-                    key_name = "RIGHT"
-                elif char == b'\xe0K':
-                    key_name = "LEFT"
-                elif char == b'\r':
-                    key_name = "ENTER"
-                # POSIX/ANSI String Mapping
-                elif char == '\x1b[A':
-                    key_name = "UP"
-                elif char == '\x1b[B':
-                    key_name = "DOWN"
-                elif char == '\x1b[C':
-                    key_name = "RIGHT"
-                elif char == '\x1b[D':
-                    key_name = "LEFT"
-                elif char in ('\r', '\n'):
-                    key_name = "ENTER"
-                else:
-                    try:
-                        key_name = char.decode('utf-8') if isinstance(char, bytes) else char
-                    except:
-                        key_name = str(char)
-
-                with _lock:
-                    last_key = key_name
-
-            time.sleep(0.01)
+        if source is not None:
+            reader = _read_source(source)
+        elif sys.platform == 'win32':
+            reader = _read_windows()
+        else:
+            reader = _read_posix()
+        for char in reader:
+            push_key(_key_name(char))
 
     except Exception as e:
-        pass  # Handle errors silently in kernel
+        _log_error(f"listener stopped: {e!r}")
     finally:
         # IMPORTANT: This restores the terminal to "Normal" mode (Cooked mode)
         # This allows standard input() to see characters and backspaces again.
-        if sys.platform in ('linux', 'darwin'):
+        if raw_terminal:
             termios.tcsetattr(_fd, termios.TCSADRAIN, _old_settings)
+        # However it ended (stopped, source ran out, stdin closed, an error), nothing is listening anymore,
+        # so start_keyboard_monitoring() can start it again
+        _monitoring_active = False
+        _listener_stopped.set()
 
 
 def start_keyboard_monitoring():
     global _monitoring_active
     if _monitoring_active:
         return  # Already running
+    if _input_source is None and not terminal_attached:
+        return  # no terminal to listen to, keys can still come in through push_key()
 
+    _listener_stopped.wait()  # a previous listener might still be restoring the terminal
     _monitoring_active = True
+    _stop_requested.clear()
+    _listener_stopped.clear()
     _thread.start_new_thread(_keyboard_listener_thread, ())
 
 
 def stop_keyboard_monitoring():
     global _monitoring_active
+    if not _monitoring_active:
+        return
     _monitoring_active = False
-    # Small sleep to give the thread time to hit the 'finally' block and reset the terminal
-    time.sleep(0.1)
+    _stop_requested.set()
+    if sys.platform in ('linux', 'darwin'):
+        os.write(_wake_write, b'\0')
+    # Wait for the thread to hit the 'finally' block and reset the terminal
+    _listener_stopped.wait(1)
+
+
+def use_input_source(source):
+    """
+    Reads keys from source instead of the terminal, so everything keyboard driven also runs
+    without a TTY. source is an iterable of key names ("UP", "ENTER", "a", ...) or
+    (delay in seconds, key name) pairs. None switches back to the terminal.
+    """
+    global _input_source, _source_finished
+    was_active = _monitoring_active
+    stop_keyboard_monitoring()
+    _input_source = iter(source) if source is not None else None
+    _source_finished = False
+    if was_active:
+        start_keyboard_monitoring()
+
+
+def has_input():
+    """True if keys can come in at all: there's a terminal, or a scripted input source is set."""
+    return terminal_attached or _input_source is not None
+
+
+def input_finished():
+    """True once a scripted input source has run out and all of its keys were taken from the queue."""
+    with _lock:
+        return _input_source is not None and _source_finished and not _key_queue
+
+
+def get_key(timeout=None, wakeable=False):
+    """
+    Returns the oldest queued KeyEvent, waiting up to timeout seconds (forever if None) for one.
+    Returns None if nothing was pressed in time or right away once a scripted input source ran out,
+    and with wakeable also when wake() is called.
+    """
+    global _woken
+    with _key_available:
+        if not _key_queue and not (wakeable and _woken):
+            _key_available.wait_for(lambda: _key_queue or _source_finished or (wakeable and _woken), timeout)
+        if wakeable:
+            _woken = False
+        if _key_queue:
+            return _key_queue.popleft()
+        return None
+
+
+def wake():
+    """
+    Makes get_key(wakeable=True) return None right away (the one waiting now, or else the next one), e.g. for
+    the desktop when a program drew into its window. Other get_key() calls don't notice.
+    """
+    global _woken
+    with _key_available:
+        _woken = True
+        _key_available.notify_all()
+
+
+def iter_keys(timeout=None):
+    """Yields KeyEvents as they arrive, stops once nothing has been pressed for timeout seconds."""
+    while True:
+        event = get_key(timeout)
+        if event is None:
+            return
+        yield event
+
+
+def clear_keys():
+    with _lock:
+        _key_queue.clear()
 
 
 def get_last_key_pressed(clear_key=True):
@@ -117,4 +351,4 @@ def get_last_key_pressed(clear_key=True):
         key = last_key
         if clear_key:
             last_key = None
-        return key
\ No newline at end of file
+        return key
@@ -1,109 +1,783 @@
 # clever ahh text-based graphics
+import time
+import bisect
+import struct
+import operator
+from array import array
 
-class Bitmap:
-    def __init__(self, width, height, pixels):
+# NumPy is optional, when it's installed blits go through array views instead of python slices
+try:
+    import numpy
+except ImportError:
+    numpy = None
+if numpy is not None and array('I').itemsize != 4:
+    numpy = None  # the views below assume 32 bit pixels
+
+# Color modes a Screen can emit, shorter sequences render faster on slow terminals and serial links
+COLOR_TRUECOLOR = "truecolor"  # 38;2;r;g;b, exact colors
+COLOR_256 = "256"  # 38;5;n, nearest color of the xterm 6x6x6 cube or gray ramp
+COLOR_16 = "16"  # 30-37/90-97, nearest of the 16 basic colors
+COLOR_MODES = (COLOR_TRUECOLOR, COLOR_256, COLOR_16)
+DEFAULT_COLOR_MODE = COLOR_TRUECOLOR
+
+# Escape strings are memoized per mode and color, the caches get dropped when they grow past this so they stay bounded
+_SGR_CACHE_LIMIT = 4096
+_sgr_caches = {mode: ({}, {}) for mode in COLOR_MODES}  # mode -> (foreground cache, background cache)
+
+# Past this many separate dirty rectangles the screen just recomposites their bounding box
+_MAX_DIRTY_RECTS = 16
+
+# Side length in pixels of the tiles the screen's spatial index splits the framebuffer into
+TILE_SIZE = 16
+
+_sprite_key = operator.attrgetter("_key")
+
+
+def _cached_sgr(cache, rgb, background, mode):
+    sequence = cache.get(rgb)
+    if sequence is None:
+        if len(cache) >= _SGR_CACHE_LIMIT:
+            cache.clear()
+        sequence = cache[rgb] = Screen.rgb_to_ansi(rgb, background, mode)
+    return sequence
+
+
+# --- Color quantization ---
+# Lookup tables are built once at import, matching a color is then a few table lookups
+
+_CUBE_LEVELS = (0, 95, 135, 175, 215, 255)
+_CUBE_INDEX = [min(range(6), key=lambda i: abs(_CUBE_LEVELS[i] - v)) for v in range(256)]  # channel -> nearest level
+_GRAY_INDEX = [min(23, max(0, round((v / 3 - 8) / 10))) for v in range(766)]  # r + g + b -> nearest of the 24 gray steps
+_BASIC_COLORS = (  # xterm defaults for colors 0-15
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+)
+
+
+def _distance(r, g, b, other):
+    return (r - other[0]) ** 2 + (g - other[1]) ** 2 + (b - other[2]) ** 2
+
+
+def quantize_256(rgb):
+    """Returns the xterm-256 index nearest to a 0xRRGGBB color (16-255, the basic colors depend on the terminal theme)."""
+    r = (rgb >> 16) & 0xFF
+    g = (rgb >> 8) & 0xFF
+    b = rgb & 0xFF
+    ri, gi, bi = _CUBE_INDEX[r], _CUBE_INDEX[g], _CUBE_INDEX[b]
+    cube = (_CUBE_LEVELS[ri], _CUBE_LEVELS[gi], _CUBE_LEVELS[bi])
+    gray_step = _GRAY_INDEX[r + g + b]
+    gray_level = 8 + gray_step * 10
+    if _distance(r, g, b, (gray_level,) * 3) < _distance(r, g, b, cube):
+        return 232 + gray_step
+    return 16 + 36 * ri + 6 * gi + bi
+
+
+def quantize_16(rgb):
+    """Returns the index (0-15) of the basic color nearest to a 0xRRGGBB color."""
+    r = (rgb >> 16) & 0xFF
+    g = (rgb >> 8) & 0xFF
+    b = rgb & 0xFF
+    return min(range(16), key=lambda i: _distance(r, g, b, _BASIC_COLORS[i]))
+
+
+class Sprite:
+    """
+    Anything a Screen can draw: it has a position, a size, a z-height and can be shown or hidden.
+    Subclasses set width, height and opaque and implement draw(screen, clip).
+    """
+    def __init__(self, width, height):
         self.width = width
         self.height = height
-        self.pixels = pixels[:]  # copy list
-        # Fill with transparent pixels if not enough pixels provided
-        # 0x000000 is now treated as the transparency key.
-        missing = width * height - len(self.pixels)
-        if missing > 0:
-            self.pixels.extend([0x000000] * missing)
+        self.opaque = False  # True when the sprite covers every pixel of its bounds, lets the screen skip what is under it
         self.visible = True
         self.x = 0
         self.y = 0
         self.z = 0  # z-height for layering
+        self.screen = None  # the Screen this sprite was added to, it gets told about changes
+        self._key = None  # (z, insertion order) on its screen, what sprites get sorted by
+        self._tiles = ()  # spatial index tiles this sprite touches on its screen
+
+    def draw(self, screen, clip):
+        raise NotImplementedError
+
+    def bounds(self):
+        """Returns the (x0, y0, x1, y1) pixel rectangle the sprite covers."""
+        return (self.x, self.y, self.x + self.width, self.y + self.height)
+
+    def invalidate(self):
+        """Tells the screen the whole sprite needs to be redrawn (e.g. after changing its pixels)."""
+        if self.screen is not None and self.visible:
+            self.screen.mark_dirty(self.bounds())
 
     def move(self, dx, dy):
-        self.x += dx
-        self.y += dy
+        self.set_position(self.x + dx, self.y + dy)
 
     def set_position(self, x, y):
+        if x == self.x and y == self.y:
+            return
+        self.invalidate()  # old area
         self.x = x
         self.y = y
+        if self.screen is not None:
+            self.screen._index_sprite(self)
+        self.invalidate()  # new area
 
     def show(self):
-        self.visible = True
+        if not self.visible:
+            self.visible = True
+            self.invalidate()
 
     def hide(self):
-        self.visible = False
+        if self.visible:
+            self.invalidate()
+            self.visible = False
 
     def set_z(self, z):
+        if z == self.z:
+            return
         self.z = z
+        if self.screen is not None:
+            self.screen._restack(self)
+        self.invalidate()
+
+
+class Bitmap(Sprite):
+    def __init__(self, width, height, pixels):
+        super().__init__(width, height)
+        self.pixels = array('I', pixels)  # copy into a compact array
+        # Fill with transparent pixels if not enough pixels provided
+        # 0x000000 is now treated as the transparency key.
+        missing = width * height - len(self.pixels)
+        if missing > 0:
+            self.pixels.extend(array('I', [0x000000]) * missing)
+        self.update_mask()
+
+    def update_mask(self):
+        """
+        Precomputes the transparency mask as opaque runs per row, so blits can copy whole slices.
+        Call this again after changing self.pixels directly.
+        """
+        width = self.width
+        pixels = self.pixels
+        self.spans = []
+        self.opaque = True  # True when there is no transparent pixel at all
+        for py in range(self.height):
+            start = py * width
+            row = pixels[start:start + width]
+            transparent = row.count(0x000000)
+            if transparent == 0:
+                self.spans.append(((0, width),))
+                continue
+            self.opaque = False
+            if transparent == width:
+                self.spans.append(())
+                continue
+            runs = []
+            run_start = None
+            for px in range(width):
+                if row[px] != 0x000000:
+                    if run_start is None:
+                        run_start = px
+                elif run_start is not None:
+                    runs.append((run_start, px))
+                    run_start = None
+            if run_start is not None:
+                runs.append((run_start, width))
+            self.spans.append(tuple(runs))
+
+        if numpy is not None:
+            self._np_pixels = numpy.frombuffer(self.pixels, dtype=numpy.uint32)[:width * self.height].reshape(self.height, width)
+            self._np_mask = self._np_pixels != 0x000000
+        self.invalidate()
+
+    def draw(self, screen, clip):
+        """Copies the visible part of the bitmap into the screen framebuffer, clip is (x0, y0, x1, y1) in pixels."""
+        self.draw_at(screen, clip, self.x, self.y)
+
+    def draw_at(self, screen, clip, x, y):
+        """Like draw(), but with the bitmap's top left corner at (x, y), so one bitmap can be stamped in many places."""
+        # Clip once for the whole sprite instead of per pixel
+        x0 = max(clip[0], x)
+        y0 = max(clip[1], y)
+        x1 = min(clip[2], x + self.width)
+        y1 = min(clip[3], y + self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # Sprite-local column range
+        left = x0 - x
+        right = x1 - x
+
+        if screen.np_buffer is not None:
+            src_rows = slice(y0 - y, y1 - y)
+            src_cols = slice(left, right)
+            target = screen.np_buffer[y0:y1, x0:x1]
+            if self.opaque:
+                target[...] = self._np_pixels[src_rows, src_cols]
+            else:
+                numpy.copyto(target, self._np_pixels[src_rows, src_cols], where=self._np_mask[src_rows, src_cols])
+            return
+
+        buffer = screen.pixel_buffer
+        buffer_width = screen.width_pixels
+        pixels = self.pixels
+        width = self.width
+        for screen_y in range(y0, y1):
+            py = screen_y - y
+            src = py * width
+            dst = screen_y * buffer_width + x
+            for start, end in self.spans[py]:
+                if start < left:
+                    start = left
+                if end > right:
+                    end = right
+                if start < end:
+                    buffer[dst + start:dst + end] = pixels[src + start:src + end]
+
+
+class Tileset:
+    """
+    Equally sized tiles (Bitmaps) shared by any number of TileMaps, tiles are referred to by index.
+    Each tile is prepared once (row spans, NumPy views), so maps only stamp finished tiles.
+    """
+    def __init__(self, tile_width, tile_height):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.tiles = []
+
+    def add(self, pixels):
+        """Adds a tile from tile_width*tile_height pixels (0x000000 is transparent) and returns its index."""
+        self.tiles.append(Bitmap(self.tile_width, self.tile_height, pixels))
+        return len(self.tiles) - 1
+
+    def add_sheet(self, width, height, pixels):
+        """Cuts a width x height sprite sheet into tiles, left to right and top to bottom, returns their indices."""
+        indices = []
+        for top in range(0, height - self.tile_height + 1, self.tile_height):
+            for left in range(0, width - self.tile_width + 1, self.tile_width):
+                tile = []
+                for row in range(top, top + self.tile_height):
+                    tile.extend(pixels[row * width + left:row * width + left + self.tile_width])
+                indices.append(self.add(tile))
+        return indices
+
+
+EMPTY_TILE = -1
+
+
+class TileMap(Sprite):
+    """
+    A width x height pixel window onto a grid of tiles from a Tileset, scrolled by scroll_x/scroll_y.
+    The map only stores a tile index per cell, so a big world costs 2 bytes per cell no matter the
+    tile size, and drawing only stamps the tiles inside the area being redrawn. Layers are just
+    several TileMaps with their own z and scroll offsets, wrap repeats the map endlessly.
+    """
+    def __init__(self, tileset, columns, rows, width, height, cells=None, wrap=False):
+        super().__init__(width, height)
+        self.tileset = tileset
+        self.columns = columns
+        self.rows = rows
+        if cells is None:
+            self.cells = array('h', [EMPTY_TILE]) * (columns * rows)  # tile index per cell, row by row
+        else:
+            self.cells = array('h', cells)
+        missing = columns * rows - len(self.cells)
+        if missing > 0:
+            self.cells.extend(array('h', [EMPTY_TILE]) * missing)
+        self.wrap = wrap
+        self.scroll_x = 0
+        self.scroll_y = 0
+        self._update_opaque()
+
+    def _tile_is_opaque(self, index):
+        return index != EMPTY_TILE and self.tileset.tiles[index].opaque
+
+    def _update_opaque(self):
+        # Opaque when every cell has an opaque tile and the window never looks past the edge of the map
+        self._see_through_cells = sum(1 for index in self.cells if not self._tile_is_opaque(index))
+        self._refresh_opaque()
+
+    def _refresh_opaque(self):
+        inside = self.wrap or (
+            self.scroll_x >= 0 and self.scroll_y >= 0
+            and self.scroll_x + self.width <= self.columns * self.tileset.tile_width
+            and self.scroll_y + self.height <= self.rows * self.tileset.tile_height
+        )
+        self.opaque = inside and self._see_through_cells == 0
+
+    def get_tile(self, column, row):
+        return self.cells[row * self.columns + column]
+
+    def set_tile(self, column, row, index):
+        """Puts a tile (or EMPTY_TILE) into a cell and redraws just that cell."""
+        if index != EMPTY_TILE and not 0 <= index < len(self.tileset.tiles):
+            raise IndexError(f"tileset has no tile {index}")
+        position = row * self.columns + column
+        old_index = self.cells[position]
+        if old_index == index:
+            return
+        self._see_through_cells += self._tile_is_opaque(old_index) - self._tile_is_opaque(index)
+        self.cells[position] = index
+        self._refresh_opaque()
+        self._invalidate_cell(column, row)
+
+    def fill(self, index):
+        self.cells = array('h', [index]) * (self.columns * self.rows)
+        self._update_opaque()
+        self.invalidate()
+
+    def _invalidate_cell(self, column, row):
+        if self.screen is None or not self.visible:
+            return
+        tile_width = self.tileset.tile_width
+        tile_height = self.tileset.tile_height
+        left = self.x - self.scroll_x + column * tile_width
+        top = self.y - self.scroll_y + row * tile_height
+        if self.wrap:
+            # The cell shows up once per repetition of the map, just redraw the window
+            self.invalidate()
+            return
+        x0, y0 = max(left, self.x), max(top, self.y)
+        x1, y1 = min(left + tile_width, self.x + self.width), min(top + tile_height, self.y + self.height)
+        if x0 < x1 and y0 < y1:
+            self.screen.mark_dirty((x0, y0, x1, y1))
+
+    def scroll_to(self, scroll_x, scroll_y):
+        """Moves the window over the map, the whole window is redrawn."""
+        if scroll_x == self.scroll_x and scroll_y == self.scroll_y:
+            return
+        self.scroll_x = scroll_x
+        self.scroll_y = scroll_y
+        self._refresh_opaque()
+        self.invalidate()
+
+    def scroll(self, dx, dy):
+        self.scroll_to(self.scroll_x + dx, self.scroll_y + dy)
+
+    def draw(self, screen, clip):
+        x0 = max(clip[0], self.x)
+        y0 = max(clip[1], self.y)
+        x1 = min(clip[2], self.x + self.width)
+        y1 = min(clip[3], self.y + self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        window = (x0, y0, x1, y1)
+        tiles = self.tileset.tiles
+        tile_width = self.tileset.tile_width
+        tile_height = self.tileset.tile_height
+        columns = self.columns
+        rows = self.rows
+        cells = self.cells
+        # Screen position of map pixel (0, 0)
+        origin_x = self.x - self.scroll_x
+        origin_y = self.y - self.scroll_y
+
+        # Only the tiles overlapping the clipped window get stamped
+        for tile_row in range((y0 - origin_y) // tile_height, (y1 - 1 - origin_y) // tile_height + 1):
+            row = tile_row % rows if self.wrap else tile_row
+            if not 0 <= row < rows:
+                continue
+            top = origin_y + tile_row * tile_height
+            for tile_column in range((x0 - origin_x) // tile_width, (x1 - 1 - origin_x) // tile_width + 1):
+                column = tile_column % columns if self.wrap else tile_column
+                if not 0 <= column < columns:
+                    continue
+                index = cells[row * columns + column]
+                if index != EMPTY_TILE:
+                    tiles[index].draw_at(screen, window, origin_x + tile_column * tile_width, top)
+
+
+class Surface(Sprite):
+    """
+    An offscreen framebuffer that gets drawn on (fill, blit, set_pixel) instead of holding a fixed image, like a
+    program's window. Its pixels stay around between frames, so moving or uncovering it only copies them again.
+    Drawing just collects the changed area and present() hands it to the screen, so many small changes cost one
+    recomposite. Every pixel gets drawn, 0x000000 is black here and not transparent.
+    """
+    def __init__(self, width, height, color=0x000000):
+        super().__init__(width, height)
+        self.pixels = array('I', [color]) * (width * height)
+        self.opaque = True
+        self.damage = None  # (x0, y0, x1, y1) in surface pixels, changed since the last present()
+        self._np_pixels = None
+        if numpy is not None:
+            self._np_pixels = numpy.frombuffer(self.pixels, dtype=numpy.uint32).reshape(height, width)
+
+    def _clip(self, x, y, width, height):
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + width, self.width)
+        y1 = min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def _damage(self, x0, y0, x1, y1):
+        if self.damage is not None:
+            x0, y0 = min(x0, self.damage[0]), min(y0, self.damage[1])
+            x1, y1 = max(x1, self.damage[2]), max(y1, self.damage[3])
+        self.damage = (x0, y0, x1, y1)
+
+    def fill(self, color, x=0, y=0, width=None, height=None):
+        """Fills a rectangle (the whole surface by default) with one color."""
+        rect = self._clip(x, y, self.width if width is None else width, self.height if height is None else height)
+        if rect is None:
+            return
+        x0, y0, x1, y1 = rect
+        row = array('I', [color]) * (x1 - x0)
+        for py in range(y0, y1):
+            start = py * self.width
+            self.pixels[start + x0:start + x1] = row
+        self._damage(x0, y0, x1, y1)
+
+    def blit(self, x, y, width, height, pixels):
+        """Copies a width x height block of pixels (row by row) to (x, y), whatever is outside the surface is cut off."""
+        rect = self._clip(x, y, width, height)
+        if rect is None:
+            return
+        if len(pixels) < width * height:
+            raise ValueError(f"a {width}x{height} block needs {width * height} pixels, got {len(pixels)}")
+        if not isinstance(pixels, array):
+            pixels = array('I', pixels)
+        x0, y0, x1, y1 = rect
+        for py in range(y0, y1):
+            src = (py - y) * width + x0 - x
+            dst = py * self.width
+            self.pixels[dst + x0:dst + x1] = pixels[src:src + x1 - x0]
+        self._damage(x0, y0, x1, y1)
+
+    def set_pixel(self, x, y, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.pixels[y * self.width + x] = color
+            self._damage(x, y, x + 1, y + 1)
+
+    def present(self):
+        """Marks what was drawn since the last present() dirty on the screen, returns False if nothing was."""
+        if self.damage is None:
+            return False
+        x0, y0, x1, y1 = self.damage
+        self.damage = None
+        if self.screen is not None and self.visible:
+            self.screen.mark_dirty((self.x + x0, self.y + y0, self.x + x1, self.y + y1))
+        return True
+
+    def draw(self, screen, clip):
+        x0 = max(clip[0], self.x)
+        y0 = max(clip[1], self.y)
+        x1 = min(clip[2], self.x + self.width)
+        y1 = min(clip[3], self.y + self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        left = x0 - self.x
+        right = x1 - self.x
+        if screen.np_buffer is not None:
+            screen.np_buffer[y0:y1, x0:x1] = self._np_pixels[y0 - self.y:y1 - self.y, left:right]
+            return
+        buffer = screen.pixel_buffer
+        buffer_width = screen.width_pixels
+        for screen_y in range(y0, y1):
+            src = (screen_y - self.y) * self.width
+            dst = screen_y * buffer_width + self.x
+            buffer[dst + left:dst + right] = self.pixels[src + left:src + right]
 
 
 class Screen:
-    def __init__(self, width_chars, height_chars):
+    def __init__(self, width_chars, height_chars, color_mode=None):
         # width_chars, height_chars = size in character cells
         # each character cell = 2 vertical pixels
+        self.color_mode = color_mode or DEFAULT_COLOR_MODE
+        if self.color_mode not in COLOR_MODES:
+            raise ValueError(f"unknown color mode '{self.color_mode}', use one of {', '.join(COLOR_MODES)}")
         self.width_chars = width_chars
         self.height_chars = height_chars
         self.width_pixels = width_chars
         self.height_pixels = height_chars * 2
         self.clear_color = 0x000000  # Clear color is transparent black
-        self.sprites = []
+        self.sprites = []  # kept in z-order (ties in the order they were added), bottom first
+        self._sprite_keys = []  # the sprites' _key, in the same order, for bisecting
+        self._next_order = 0
+        self._tiles = {}  # (tile x, tile y) -> set of sprites touching that tile, off-screen sprites are in none
+        # Flat framebuffer, pixel (x, y) lives at y * width_pixels + x
+        self._blank_color = self.clear_color
+        self._blank_buffer = array('I', [self.clear_color]) * (self.width_pixels * self.height_pixels)
+        self.pixel_buffer = array('I', self._blank_buffer)
+        self.np_buffer = None  # 2D NumPy view over pixel_buffer when NumPy is available
+        if numpy is not None:
+            self.np_buffer = numpy.frombuffer(self.pixel_buffer, dtype=numpy.uint32).reshape(self.height_pixels, self.width_pixels)
+        self.origin = (1, 1)  # terminal row/col (1-based) that render_delta() draws the top left cell at
+        # Dirty-rectangle tracking, only these pixel areas get recomposited on the next render
+        self.dirty = []  # merged (x0, y0, x1, y1) rectangles
+        self._cells = [[] for _ in range(height_chars)]  # (top, bottom) pairs per character row
+        self._row_strings = [None] * height_chars  # encoded rows for render(), None when stale
+        self._frame = None  # the last full render() string
+        self._delta_rows = set()  # character rows changed since the last render_delta()
+        self._last_cells = None  # cells from the last render_delta(), used to find what changed
+        self.mark_dirty((0, 0, self.width_pixels, self.height_pixels))
 
     def add_sprite(self, sprite):
-        self.sprites.append(sprite)
-        self.sort_sprites()
+        if sprite.screen is not None:
+            sprite.screen.remove_sprite(sprite)
+        sprite.screen = self
+        sprite._key = (sprite.z, self._next_order)
+        self._next_order += 1
+        self._insert_sorted(sprite)
+        self._index_sprite(sprite)
+        sprite.invalidate()
 
     def remove_sprite(self, sprite):
-        if sprite in self.sprites:
-            self.sprites.remove(sprite)
+        if sprite.screen is self:
+            sprite.invalidate()
+            index = bisect.bisect_left(self._sprite_keys, sprite._key)
+            del self._sprite_keys[index]
+            del self.sprites[index]
+            for tile in sprite._tiles:
+                self._tiles[tile].discard(sprite)
+            sprite._tiles = ()
+            sprite.screen = None
+
+    def _insert_sorted(self, sprite):
+        index = bisect.bisect(self._sprite_keys, sprite._key)
+        self._sprite_keys.insert(index, sprite._key)
+        self.sprites.insert(index, sprite)
+
+    def _restack(self, sprite):
+        """Moves a sprite to its place for its new z."""
+        index = bisect.bisect_left(self._sprite_keys, sprite._key)
+        del self._sprite_keys[index]
+        del self.sprites[index]
+        sprite._key = (sprite.z, sprite._key[1])
+        self._insert_sorted(sprite)
 
     def sort_sprites(self):
-        self.sprites.sort(key=lambda s: s.z)
+        """Re-sorts everything, only needed after changing a sprite's z without set_z()."""
+        for sprite in self.sprites:
+            sprite._key = (sprite.z, sprite._key[1])
+        self.sprites.sort(key=lambda s: s._key)
+        self._sprite_keys = [sprite._key for sprite in self.sprites]
+        self.invalidate()
+
+    def _index_sprite(self, sprite):
+        """Files a sprite under the tiles its bounds touch."""
+        x0 = max(sprite.x, 0)
+        y0 = max(sprite.y, 0)
+        x1 = min(sprite.x + sprite.width, self.width_pixels)
+        y1 = min(sprite.y + sprite.height, self.height_pixels)
+        if x0 >= x1 or y0 >= y1:
+            tiles = ()
+        else:
+            tiles = tuple((tx, ty)
+                          for ty in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1)
+                          for tx in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1))
+        if tiles == sprite._tiles:
+            return
+        for tile in sprite._tiles:
+            self._tiles[tile].discard(sprite)
+        for tile in tiles:
+            bucket = self._tiles.get(tile)
+            if bucket is None:
+                bucket = self._tiles[tile] = set()
+            bucket.add(sprite)
+        sprite._tiles = tiles
+
+    def mark_dirty(self, rect):
+        """Queues a pixel rectangle for recompositing, overlapping or touching rectangles are merged."""
+        x0 = max(rect[0], 0)
+        y0 = max(rect[1], 0)
+        x1 = min(rect[2], self.width_pixels)
+        y1 = min(rect[3], self.height_pixels)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        merged = True
+        while merged:
+            merged = False
+            for index, (ox0, oy0, ox1, oy1) in enumerate(self.dirty):
+                if x0 <= ox1 and ox0 <= x1 and y0 <= oy1 and oy0 <= y1:
+                    x0, y0, x1, y1 = min(x0, ox0), min(y0, oy0), max(x1, ox1), max(y1, oy1)
+                    del self.dirty[index]
+                    merged = True
+                    break
+        self.dirty.append((x0, y0, x1, y1))
+
+        # Lots of tiny rectangles cost more to walk than one big one
+        if len(self.dirty) > _MAX_DIRTY_RECTS:
+            self.dirty = [(
+                min(r[0] for r in self.dirty), min(r[1] for r in self.dirty),
+                max(r[2] for r in self.dirty), max(r[3] for r in self.dirty),
+            )]
+
+    def clear(self, rect=None):
+        if self._blank_color != self.clear_color:
+            self._blank_buffer = array('I', [self.clear_color]) * (self.width_pixels * self.height_pixels)
+            self._blank_color = self.clear_color
+        if rect is None:
+            self.pixel_buffer[:] = self._blank_buffer
+            return
+        x0, y0, x1, y1 = rect
+        blank = self._blank_buffer[:x1 - x0]
+        for y in range(y0, y1):
+            start = y * self.width_pixels
+            self.pixel_buffer[start + x0:start + x1] = blank
+
+    def _composite(self):
+        """Recomposites the dirty rectangles and returns them."""
+        if self._blank_color != self.clear_color:
+            self.invalidate()
+        rects = self.dirty
+        self.dirty = []
+        tiles = self._tiles
+        for rect in rects:
+            x0, y0, x1, y1 = rect
+            # Only sprites filed under the tiles this rectangle touches can show up in it
+            candidates = set()
+            for ty in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1):
+                for tx in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1):
+                    bucket = tiles.get((tx, ty))
+                    if bucket:
+                        candidates.update(bucket)
+            stack = sorted([sprite for sprite in candidates if sprite.visible], key=_sprite_key)
 
-    def clear(self):
-        self.pixel_buffer = [
-            [self.clear_color for _ in range(self.width_pixels)]
-            for __ in range(self.height_pixels)
-        ]
+            # Whatever is under the topmost opaque sprite covering the whole rectangle can't be seen, start drawing there
+            for index in range(len(stack) - 1, -1, -1):
+                sprite = stack[index]
+                if (sprite.opaque and sprite.x <= x0 and sprite.y <= y0
+                        and sprite.x + sprite.width >= x1 and sprite.y + sprite.height >= y1):
+                    stack = stack[index:]
+                    break
+            else:
+                self.clear(rect)
+            # Draw sprites in z-order
+            for sprite in stack:
+                sprite.draw(self, rect)
+        return rects
+
+    def update(self):
+        """Recomposites whatever is dirty and refreshes the cached cells for the character rows it touched."""
+        width = self.width_pixels
+        buffer = self.pixel_buffer
+        for x0, y0, x1, y1 in self._composite():
+            for char_row in range(y0 // 2, (y1 + 1) // 2):
+                start = char_row * 2 * width
+                # Rows are replaced instead of changed in place, _last_cells may still share the old one
+                row = self._cells[char_row][:]
+                row[x0:x1] = zip(buffer[start + x0:start + x1], buffer[start + width + x0:start + width + x1])
+                self._cells[char_row] = row
+                self._row_strings[char_row] = None
+                self._delta_rows.add(char_row)
+                self._frame = None
+
+    def cell_rows(self):
+        """Returns the framebuffer as rows of (top, bottom) pixel pairs, one pair per character cell."""
+        self.update()
+        return self._cells[:]
+
+    def encode_cells(self, cells):
+        """
+        Turns a run of (top, bottom) cells into one ANSI string.
+        Colors are only sent when they differ from the previous cell and the attributes are reset once at the end.
+        """
+        # For lower half block: top pixel becomes background, bottom pixel becomes foreground.
+        mode = self.color_mode
+        fg_cache, bg_cache = _sgr_caches[mode]
+        out = []
+        fg = bg = None
+        fg_sequence = bg_sequence = None
+        for top_pixel, bot_pixel in cells:
+            if bot_pixel != fg:
+                fg = bot_pixel
+                # Different colors can quantize to the same sequence, only send it when it changes
+                sequence = fg_cache.get(bot_pixel) or _cached_sgr(fg_cache, bot_pixel, False, mode)
+                if sequence != fg_sequence:
+                    out.append(sequence)
+                    fg_sequence = sequence
+            if top_pixel != bg:
+                bg = top_pixel
+                sequence = bg_cache.get(top_pixel) or _cached_sgr(bg_cache, top_pixel, True, mode)
+                if sequence != bg_sequence:
+                    out.append(sequence)
+                    bg_sequence = sequence
+            out.append("\u2584")  # lower half block
+        out.append("\033[0m")
+        return "".join(out)
 
     def render(self):
-        self.clear()
-        # Draw sprites in z-order
-        for sprite in self.sprites:
-            if not sprite.visible:
-                continue
-            for py in range(sprite.height):
-                screen_y = sprite.y + py
-                if 0 <= screen_y < self.height_pixels:
-                    for px in range(sprite.width):
-                        screen_x = sprite.x + px
-                        if 0 <= screen_x < self.width_pixels:
-                            pixel_color = sprite.pixels[py * sprite.width + px]
-
-                            # If the pixel is not the transparency key (0x000000), draw it.
-                            if pixel_color != 0x000000:
-                                self.pixel_buffer[screen_y][screen_x] = pixel_color
-
-        # Now convert pixel_buffer to text lines using lower-half block chars
-        lines = []
-        for char_row in range(self.height_chars):
-            line_chars = []
-            top_row = char_row * 2
-            bot_row = top_row + 1
-            for char_col in range(self.width_chars):
-                top_pixel = self.pixel_buffer[top_row][char_col]
-                bot_pixel = (
-                    self.pixel_buffer[bot_row][char_col]
-                    if bot_row < self.height_pixels
-                    else self.clear_color
-                )
-
-                # Compose ANSI escape for fg/bg color and lower half block char
-                # For lower half block: top pixel becomes background, bottom pixel becomes foreground.
-                fg = self.rgb_to_ansi(bot_pixel, background=False)
-                bg = self.rgb_to_ansi(top_pixel, background=True)
-                char = "\u2584"  # lower half block
-                line_chars.append(f"{fg}{bg}{char}\033[0m")
-            lines.append("".join(line_chars))
-        return "\n".join(lines)
+        self.update()
+        if self._frame is None:
+            # Now convert the cells to text lines using lower-half block chars, only rows that changed get encoded again
+            for char_row, row in enumerate(self._cells):
+                if self._row_strings[char_row] is None:
+                    self._row_strings[char_row] = self.encode_cells(row)
+            self._frame = "\n".join(self._row_strings)
+        return self._frame
+
+    def is_dirty(self):
+        """True when the next render_delta() would send something to the terminal."""
+        return bool(self.dirty) or self._last_cells is None or self._blank_color != self.clear_color
+
+    def invalidate(self):
+        """Recomposites everything on the next render and makes the next render_delta() redraw the whole terminal."""
+        self.dirty = []
+        self.mark_dirty((0, 0, self.width_pixels, self.height_pixels))
+        self._last_cells = None
+
+    def render_delta(self):
+        """
+        Like render(), but only returns what changed since the last render_delta() call.
+        Changed cells are addressed with cursor positioning escapes, so the output can be
+        written straight to the terminal without clearing it first. The first frame (or the
+        first one after invalidate()) clears the screen and draws everything.
+        """
+        self.update()
+        cells = self._cells
+        origin_row, origin_col = self.origin
+        previous = self._last_cells
+        out = []
+
+        if previous is None:
+            out.append("\033[2J")
+            for row_index, row in enumerate(cells):
+                out.append(f"\033[{origin_row + row_index};{origin_col}H")
+                out.append(self.encode_cells(row))
+            self._last_cells = cells[:]
+        else:
+            for row_index in sorted(self._delta_rows):
+                row = cells[row_index]
+                old_row = previous[row_index]
+                if row == old_row:
+                    continue
+                col = 0
+                width = len(row)
+                while col < width:
+                    if row[col] == old_row[col]:
+                        col += 1
+                        continue
+                    # Found a run of changed cells, move the cursor once and draw the whole run
+                    run_start = col
+                    while col < width and row[col] != old_row[col]:
+                        col += 1
+                    out.append(f"\033[{origin_row + row_index};{origin_col + run_start}H")
+                    out.append(self.encode_cells(row[run_start:col]))
+                previous[row_index] = row
+
+        self._delta_rows.clear()
+        return "".join(out)
+
+    def set_color_mode(self, mode):
+        """Switches between truecolor, 256 and 16 colors, the next render redraws everything."""
+        if mode not in COLOR_MODES:
+            raise ValueError(f"unknown color mode '{mode}', use one of {', '.join(COLOR_MODES)}")
+        if mode != self.color_mode:
+            self.color_mode = mode
+            self.invalidate()
 
     @staticmethod
-    def rgb_to_ansi(rgb, background=False):
+    def rgb_to_ansi(rgb, background=False, mode=COLOR_TRUECOLOR):
+        if mode == COLOR_256:
+            return f"\033[{48 if background else 38};5;{quantize_256(rgb)}m"
+        if mode == COLOR_16:
+            index = quantize_16(rgb)
+            base = (40 if background else 30) if index < 8 else (100 if background else 90)
+            return f"\033[{base + index % 8}m"
         r = (rgb >> 16) & 0xFF
         g = (rgb >> 8) & 0xFF
         b = rgb & 0xFF
@@ -112,3 +786,171 @@ class Screen:
             if background
             else f"\033[38;2;{r};{g};{b}m"
         )
+
+
+# --- Sprite files ---
+# Binary sprites (.spr) instead of hex text: a palette plus run-length encoded palette indices.
+# Palette entry 0 is always transparent (0x000000), so a sprite has at most 255 real colors.
+#
+# Layout (little endian):
+#     header:  b"ESPR", version (B), width (H), height (H), palette size (H)
+#     palette: 3 bytes (r, g, b) per entry
+#     data:    packets over the row-major indices, a control byte c followed by
+#              c < 128:  c + 1 literal indices
+#              c >= 128: one index repeated c - 126 times (2 to 129)
+
+SPRITE_MAGIC = b"ESPR"
+SPRITE_VERSION = 1
+_SPRITE_HEADER = struct.Struct("<4sBHHH")
+
+
+def encode_sprite(width, height, pixels):
+    """Packs width*height 0xRRGGBB pixels into sprite file bytes. Raises ValueError past 255 colors."""
+    count = width * height
+    pixels = list(pixels[:count]) + [0x000000] * (count - len(pixels))
+    lookup = {0x000000: 0}
+    for color in pixels:
+        if color not in lookup:
+            lookup[color] = len(lookup)
+    if len(lookup) > 256:
+        raise ValueError(f"sprite has {len(lookup) - 1} colors, at most 255 fit in a palette")
+    indices = bytes(lookup[color] for color in pixels)
+
+    out = bytearray(_SPRITE_HEADER.pack(SPRITE_MAGIC, SPRITE_VERSION, width, height, len(lookup)))
+    for color in lookup:  # dicts keep insertion order, so this is palette order
+        out += color.to_bytes(3, "big")
+    i = 0
+    while i < count:
+        run = 1
+        while i + run < count and run < 129 and indices[i + run] == indices[i]:
+            run += 1
+        if run >= 2:
+            out += bytes((run + 126, indices[i]))
+            i += run
+            continue
+        # Literal packet until the next run starts
+        start = i
+        i += 1
+        while i < count and i - start < 128 and not (i + 1 < count and indices[i] == indices[i + 1]):
+            i += 1
+        out.append(i - start - 1)
+        out += indices[start:i]
+    return bytes(out)
+
+
+def decode_sprite(data):
+    """Unpacks sprite file bytes (any buffer, e.g. a memoryview from vfs.read_view) into (width, height, pixels)."""
+    view = memoryview(data)
+    magic, version, width, height, colors = _SPRITE_HEADER.unpack_from(view, 0)
+    if magic != SPRITE_MAGIC or version != SPRITE_VERSION:
+        raise ValueError("not an ElapticOS sprite")
+    position = _SPRITE_HEADER.size
+    palette = [int.from_bytes(view[position + i * 3:position + i * 3 + 3], "big") for i in range(colors)]
+    palette[0] = 0x000000
+    position += colors * 3
+
+    count = width * height
+    indices = bytearray()
+    end = len(view)
+    while position < end and len(indices) < count:
+        control = view[position]
+        if control < 128:
+            indices += view[position + 1:position + control + 2]
+            position += control + 2
+        else:
+            indices += bytes((view[position + 1],)) * (control - 126)
+            position += 2
+    del indices[count:]
+    # map() walks the indices in C, the palette turns them straight into pixels
+    return width, height, array('I', map(palette.__getitem__, indices))
+
+
+def load_sprite(data):
+    """Builds a Bitmap straight from sprite file bytes."""
+    width, height, pixels = decode_sprite(data)
+    return Bitmap(width, height, pixels)
+
+
+# --- Frame output ---
+# Anything with write(frame) and flush() can take the frames a Screen renders. FrameSink just
+# counts them, so rendering can be driven and measured without a terminal. FrameRecorder also
+# saves every frame with its timestamp so a session can be replayed later.
+#
+# Recording layout (little endian):
+#     header: b"EREC", version (B)
+#     frames: seconds since the first frame (d), length (I), frame text (utf-8)
+
+RECORDING_MAGIC = b"EREC"
+RECORDING_VERSION = 1
+_RECORDING_HEADER = struct.Struct("<4sB")
+_RECORDING_FRAME = struct.Struct("<dI")
+
+
+class FrameSink:
+    """A frame output without a terminal behind it, it only keeps count of frames and bytes."""
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, frame):
+        self.frames += 1
+        self.bytes += len(frame.encode("utf-8"))
+
+    def flush(self):
+        pass
+
+
+class FrameRecorder(FrameSink):
+    """Writes every frame into a binary stream, and passes it on to echo (e.g. sys.stdout) if given."""
+    def __init__(self, stream, echo=None):
+        super().__init__()
+        self.stream = stream
+        self.echo = echo
+        self.started = None
+        stream.write(_RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+
+    def write(self, frame):
+        data = frame.encode("utf-8")
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        self.stream.write(_RECORDING_FRAME.pack(now - self.started, len(data)))
+        self.stream.write(data)
+        self.frames += 1
+        self.bytes += len(data)
+        if self.echo is not None:
+            self.echo.write(frame)
+
+    def flush(self):
+        self.stream.flush()
+        if self.echo is not None:
+            self.echo.flush()
+
+
+def read_frames(data):
+    """Yields (seconds since the first frame, frame text) from a recording's bytes."""
+    view = memoryview(data)
+    magic, version = _RECORDING_HEADER.unpack_from(view, 0)
+    if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+        raise ValueError("not an ElapticOS frame recording")
+    position = _RECORDING_HEADER.size
+    while position + _RECORDING_FRAME.size <= len(view):
+        timestamp, length = _RECORDING_FRAME.unpack_from(view, position)
+        position += _RECORDING_FRAME.size
+        yield timestamp, bytes(view[position:position + length]).decode("utf-8")
+        position += length
+
+
+def replay_frames(data, output, speed=1.0):
+    """Plays a recording back into output with its original timing (speed 2 is twice as fast, 0 is no waiting). Returns the frame count."""
+    started = time.monotonic()
+    frames = 0
+    for timestamp, frame in read_frames(data):
+        if speed > 0:
+            delay = started + timestamp / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        output.write(frame)
+        output.flush()
+        frames += 1
+    return frames
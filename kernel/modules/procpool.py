@@ -0,0 +1,569 @@
+# --------PROCESS POOL--------
+# User programs run in pre-forked worker processes instead of the kernel process, so a
+# runaway program can be limited, killed or restarted without stalling the shell or ede.
+# Workers run scripts with the same sandbox as interpreter.run_script, and their 'api'
+# calls are sent back to the kernel over a pipe and run there.
+# Variables a program sets are thrown away when it finishes, they don't end up in the shell
+# session or in the next program the same worker runs.
+# What a program prints is sent to the kernel's console in chunks as well, see _ConsolePipe.
+
+interpreter = __elaptic_registry__['interpreter']
+api = __elaptic_registry__['api']
+time = __elaptic_registry__['time']
+os = __elaptic_registry__['os']
+sys = __elaptic_registry__['sys']
+trace = __elaptic_registry__['trace']
+console = __elaptic_registry__['console']
+import queue
+import types
+import signal
+import collections
+import contextvars
+import threading
+import tracemalloc
+import multiprocessing
+import multiprocessing.util
+try:
+    import resource
+except ImportError:
+    resource = None  # no CPU limits on this platform
+
+POOL_SIZE = 2  # idle workers kept forked and ready to go
+DEFAULT_CPU_LIMIT = None  # seconds of CPU time a program may use, None for no limit
+DEFAULT_WALL_LIMIT = None  # seconds a program may run, None for no limit
+DEFAULT_MEMORY_LIMIT = None  # bytes a program may have allocated at its peak, None for no limit
+DEFAULT_OUTPUT_LIMIT = None  # bytes a program may print, None for no limit
+# Peak allocations are measured with tracemalloc, which slows allocation heavy programs down a lot (10x in
+# a tight loop), so only programs with a memory quota get it unless this is set
+TRACK_MEMORY = False
+MEMORY_CHECK_INTERVAL = 0.01  # seconds between a worker's checks against its memory quota
+OUTPUT_CHUNK_SIZE = 4096  # characters a worker collects before sending them without waiting for the flush interval
+USAGE_HISTORY = 100  # finished programs 'usage' still lists after reap() dropped them
+
+# Workers are forked so they inherit the loaded kernel, platforms without fork run programs in threads
+_context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100  # units of the CPU times in /proc
+
+
+# --- Worker side ---
+
+class CpuLimitExceeded(interpreter.QuotaExceeded):
+    pass
+
+
+_quota_hit = None  # which quota stopped the current program, reported back with the result
+_running = False  # a program is running in this worker right now
+_memory_watch = threading.Event()  # set while a program with a memory quota runs
+_memory_limit = None
+
+
+def _on_cpu_limit(signum, frame):
+    global _quota_hit
+    _quota_hit = "cpu"
+    raise CpuLimitExceeded("CPU time limit exceeded")
+
+
+def _on_memory_limit(signum, frame):
+    if _running:  # the program may have just finished
+        raise interpreter.QuotaExceeded(f"memory quota exceeded ({_memory_limit} bytes)")
+
+
+def _memory_watchdog(main_thread):
+    # tracemalloc can't call us on an allocation, so this polls the peak and interrupts the program with a signal
+    global _quota_hit
+    while True:
+        _memory_watch.wait()
+        time.sleep(MEMORY_CHECK_INTERVAL)
+        if _memory_watch.is_set() and _quota_hit is None and tracemalloc.get_traced_memory()[1] > _memory_limit:
+            _quota_hit = "memory"
+            _memory_watch.clear()
+            signal.pthread_kill(main_thread, signal.SIGUSR1)
+
+
+class _ConsolePipe:
+    """
+    A worker's stdout. Prints are collected and sent to the kernel's console in one message: once
+    OUTPUT_CHUNK_SIZE piled up, before any other message to the kernel, and otherwise at the latest
+    console.FLUSH_INTERVAL after the first of them. The kernel stops reading while the program's
+    console buffer is full, then the pipe fills up and send() blocks the program until it drains.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()  # the flush thread sends too
+        self._parts = []
+        self._size = 0
+        self._waiting = threading.Event()
+        threading.Thread(target=self._flush_later, daemon=True).start()
+
+    def _send_output(self):
+        # Callers hold _lock
+        if self._parts:
+            self._conn.send(("write", "".join(self._parts)))
+            self._parts.clear()
+            self._size = 0
+
+    def write(self, text):
+        with self._lock:
+            self._parts.append(text)
+            self._size += len(text)
+            if self._size >= OUTPUT_CHUNK_SIZE:
+                self._send_output()
+            else:
+                self._waiting.set()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self._send_output()
+
+    def send(self, message):
+        """Sends a message to the kernel, after the output printed before it."""
+        with self._lock:
+            self._send_output()
+            self._conn.send(message)
+
+    def _flush_later(self):
+        while True:
+            self._waiting.wait()
+            time.sleep(console.FLUSH_INTERVAL)
+            self._waiting.clear()
+            self.flush()
+
+    def isatty(self):
+        return False
+
+
+class _ApiProxy:
+    """Stands in for the api module inside a worker, calls get sent to the kernel and run there."""
+    def __init__(self, conn, pipe):
+        self._conn = conn
+        self._pipe = pipe
+
+    def sleep(self, seconds):
+        # No need to bother the kernel just to sleep, but what the program printed shouldn't wait as well
+        self._pipe.flush()
+        time.sleep(seconds)
+
+    def _request(self, message):
+        self._pipe.send(message)
+        kind, value = self._conn.recv()
+        if kind == "error":
+            raise Exception(value)
+        return kind, value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        kind, value = self._request(("getattr", name))
+        if kind != "callable":
+            return value
+
+        def call(*args, **kwargs):
+            return self._request(("call", name, args, kwargs))[1]
+
+        # Functions only need looking up once
+        setattr(self, name, call)
+        return call
+
+
+def _set_cpu_limit(seconds):
+    # The profiling timer counts this process' CPU time and goes off right at the limit. RLIMIT_CPU only
+    # has whole seconds and stays as a backstop a second later, for a program stuck in a C call that
+    # doesn't get back to the interpreter to let the timer's handler run.
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    signal.setitimer(signal.ITIMER_PROF, seconds)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # RLIMIT_CPU counts the whole process lifetime, so the limit is relative to what we used so far
+    limit = int(usage.ru_utime + usage.ru_stime + seconds) + 2
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+def _worker_main(conn, kernel_conn):
+    # _fork_worker held these across the fork, nobody else in this process is going to release our copies
+    interpreter._compile_lock.release()
+    trace._lock.release()
+    # Fork handed us the kernel's end of the pipe too, without closing it we'd never see EOF when the kernel exits
+    kernel_conn.close()
+    # Ctrl-C at the shell is for the foreground program, the kernel kills that worker itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Whatever stdout the kernel had when it forked us (maybe a batch buffer), programs print to its console
+    pipe = sys.stdout = _ConsolePipe(conn)
+    if resource is not None:
+        signal.signal(signal.SIGPROF, _on_cpu_limit)
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    signal.signal(signal.SIGUSR1, _on_memory_limit)
+    threading.Thread(target=_memory_watchdog, args=(threading.get_ident(),), daemon=True).start()
+    api_proxy = _ApiProxy(conn, pipe)
+    global _quota_hit, _running, _memory_limit
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] != "run":
+            continue
+        _, source, (cpu_limit, memory_limit, output_limit), tracing = message
+        _quota_hit = None
+        if resource is not None:
+            _set_cpu_limit(cpu_limit)
+        # Spans recorded here get shipped back with the result, the kernel merges them into its trace
+        trace.clear()
+        trace.enabled = tracing
+        output = sys.stdout = interpreter.OutputMeter(pipe, output_limit)
+        tracking_memory = TRACK_MEMORY or memory_limit is not None
+        if tracking_memory:
+            tracemalloc.start()
+            if memory_limit is not None:
+                _memory_limit = memory_limit
+                _memory_watch.set()
+        cpu_started = time.process_time()
+        _running = True
+        try:
+            try:
+                result = interpreter.run_script(source, api_proxy, merge=False)
+            finally:
+                _running = False
+                _memory_watch.clear()
+                if resource is not None:
+                    _set_cpu_limit(None)
+        except interpreter.QuotaExceeded as e:  # the signal came in just as the script returned
+            result = f"Script Error: {e}"
+        peak_memory = None
+        if tracking_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        usage = {
+            "cpu": time.process_time() - cpu_started,
+            "peak_memory": peak_memory,
+            "output_bytes": output.bytes,
+            "quota": "output" if output.exceeded else _quota_hit,
+        }
+        pipe.send(("done", result, usage, trace.drain() if tracing else None))  # output goes first
+
+
+# --- Kernel side ---
+
+class Program:
+    def __init__(self, pid, name, source, cpu_limit, wall_limit, memory_limit=None, output_limit=None):
+        self.pid = pid
+        self.name = name
+        self.source = source
+        self.cpu_limit = cpu_limit
+        self.wall_limit = wall_limit
+        self.memory_limit = memory_limit
+        self.output_limit = output_limit
+        self.status = "starting"  # running, done, killed, timeout, quota or crashed
+        self.result = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.worker = None
+        self.done = threading.Event()
+        self.cpu = 0.0  # CPU seconds, tasks add to it as they run, workers report it when they finish
+        self.cpu_base = None  # the worker's CPU time when this program started, for reading it live
+        self.peak_memory = None  # bytes, known once a worker program finishes
+        self.output_bytes = 0
+        self.quota = None  # name of the quota that stopped it
+
+    def runtime(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def cpu_time(self):
+        """CPU seconds used so far. While a worker program runs this is read from /proc, where there is one."""
+        if self.worker is None or self.done.is_set() or self.cpu_base is None:
+            return self.cpu
+        used = _process_cpu(self.worker.process.pid)
+        return self.cpu if used is None else max(0.0, used - self.cpu_base)
+
+    def finish(self, status, result):
+        self.status = status
+        self.result = result
+        self.finished = time.monotonic()
+        self.done.set()
+
+
+# Workers are all forked from one thread of their own, never from whichever thread (shell, desktop,
+# scheduler) ran out of idle workers. A fork copies every lock in the state it is in right then, and
+# one held by another thread stays held forever in the child. So the fork thread takes the locks a
+# worker uses itself (compiling, tracing) around the fork, and the worker lets go of its copies.
+
+_fork_requests = queue.SimpleQueue()
+_fork_thread = None
+
+
+def _fork_worker():
+    # Runs on the fork thread. One fork at a time, so a worker only inherits pipes of workers older than itself
+    # and they still close in a chain.
+    with _fork_lock:
+        if _shutting_down:
+            raise RuntimeError("the kernel is shutting down")
+        conn, child_conn = _context.Pipe()
+        process = _context.Process(target=_worker_main, args=(child_conn, conn), daemon=True)
+        with interpreter._compile_lock, trace._lock:
+            process.start()
+        child_conn.close()
+    return conn, process
+
+
+def _fork_loop():
+    while True:
+        request = _fork_requests.get()
+        try:
+            request.result = _fork_worker()
+        except Exception as e:
+            request.error = e
+        request.done.set()
+
+
+def _fork():
+    global _fork_thread
+    with _lock:
+        if _fork_thread is None:
+            _fork_thread = threading.Thread(target=_fork_loop, name="procpool fork", daemon=True)
+            _fork_thread.start()
+    request = types.SimpleNamespace(done=threading.Event(), result=None, error=None)
+    _fork_requests.put(request)
+    request.done.wait()
+    if request.error is not None:
+        raise request.error
+    return request.result
+
+
+class _Worker:
+    def __init__(self):
+        self.conn, self.process = _fork()
+
+
+programs = {}  # pid -> Program, finished programs stay until reap() picks them up
+finished = collections.deque(maxlen=USAGE_HISTORY)  # what reap() dropped, newest last
+# The Program an api call is being made for, None for the shell. Set in each program's _serve thread and task.
+current_program = contextvars.ContextVar("current_program", default=None)
+_idle_workers = []
+_lock = threading.Lock()
+_fork_lock = threading.Lock()
+_shutting_down = False
+_next_pid = 1
+
+
+def prefork():
+    """Forks idle workers until there are POOL_SIZE of them, the kernel calls this once it has booted."""
+    if _context is None:
+        return
+    with _lock:
+        missing = POOL_SIZE - len(_idle_workers)
+    for _ in range(missing):
+        try:
+            worker = _Worker()
+        except RuntimeError:
+            return
+        with _lock:
+            _idle_workers.append(worker)
+
+
+def shutdown():
+    """Stops forking new workers and kills the idle ones. Runs at exit right before multiprocessing reaps its
+    children, so no worker gets forked after that and left waiting on a kernel that is gone."""
+    global _shutting_down
+    with _fork_lock:
+        _shutting_down = True
+    with _lock:
+        idle = _idle_workers[:]
+        _idle_workers.clear()
+    for worker in idle:
+        worker.process.kill()
+        worker.conn.close()
+
+
+multiprocessing.util.Finalize(None, shutdown, exitpriority=10)
+
+
+def _process_cpu(pid):
+    """CPU seconds (user + system) a process has used, None without /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _take_worker():
+    with _lock:
+        while _idle_workers:
+            worker = _idle_workers.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.conn.close()
+    return _Worker()
+
+
+def _release_worker(worker):
+    with _lock:
+        if len(_idle_workers) < POOL_SIZE:
+            _idle_workers.append(worker)
+            return
+    worker.conn.close()  # the worker exits once its pipe is gone
+
+
+def _answer(conn, message):
+    """Handles an api request coming from a worker."""
+    kind, name = message[0], message[1]
+    if name.startswith("_") or not hasattr(api, name):
+        conn.send(("error", f"api has no attribute '{name}'"))
+        return
+    value = getattr(api, name)
+    if kind == "getattr":
+        if isinstance(value, types.FunctionType):
+            conn.send(("callable", None))
+        elif isinstance(value, types.ModuleType):
+            conn.send(("error", f"api has no attribute '{name}'"))
+        else:
+            conn.send(("value", value))
+    elif kind == "call" and isinstance(value, types.FunctionType):
+        try:
+            result = value(*message[2], **message[3])
+        except Exception as e:
+            conn.send(("error", repr(e)))
+            return
+        try:
+            conn.send(("value", result))
+        except Exception:
+            conn.send(("error", f"api.{name} returned something that can't leave the kernel"))
+
+
+def _serve(program):
+    """Runs in a kernel thread for as long as the program does, answering its api calls and enforcing the wall-clock limit."""
+    current_program.set(program)
+    worker = program.worker
+    deadline = program.started + program.wall_limit if program.wall_limit else None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            if not worker.conn.poll(timeout):
+                worker.process.kill()
+                program.finish("timeout", "Script Error: wall-clock time limit exceeded")
+                break
+            message = worker.conn.recv()
+        except (EOFError, OSError):
+            # Worker died, either we killed it or it crashed
+            if program.status == "running":
+                program.finish("crashed", f"Script Error: worker exited with code {worker.process.exitcode}")
+            else:
+                program.done.set()
+            break
+
+        if message[0] == "write":
+            # Waits while the program's console buffer is full, the worker waits on us in turn
+            while not console.write(program.pid, message[1], timeout=0.1):
+                if program.status != "running" or (deadline is not None and time.monotonic() > deadline):
+                    break
+            continue
+        if message[0] == "done":
+            console.close(program.pid)  # everything it printed is out before anyone sees it finish
+            usage = message[2]
+            program.cpu = usage["cpu"]
+            program.peak_memory = usage["peak_memory"]
+            program.output_bytes = usage["output_bytes"]
+            program.quota = usage["quota"]
+            if message[3]:
+                trace.merge(message[3])
+            with _lock:
+                finished = program.status == "running"
+                if finished:
+                    program.finish("quota" if program.quota else "done", message[1])
+            if finished:
+                _release_worker(worker)
+                return
+            continue  # got killed at the last moment, the pipe closes next
+        try:
+            _answer(worker.conn, message)
+        except (EOFError, OSError):
+            pass  # noticed on the next poll
+
+    console.close(program.pid)
+    worker.process.join(1)
+    worker.conn.close()
+    prefork()
+
+
+def _serve_in_thread(program):
+    # Fallback without fork: no limits and no killing, but the caller still doesn't block
+    current_program.set(program)
+    program.status = "running"
+    cpu_started = time.thread_time()
+    result = interpreter.run_script(program.source, merge=False)
+    program.cpu = time.thread_time() - cpu_started
+    program.finish("done", result)
+
+
+def allocate_pid():
+    """Hands out program ids, tasks on the kernel event loop share them so ids never clash."""
+    global _next_pid
+    with _lock:
+        pid = _next_pid
+        _next_pid += 1
+    return pid
+
+
+def spawn(source: str, name="<script>", cpu_limit=None, wall_limit=None, memory_limit=None, output_limit=None):
+    """Starts a program in a pooled worker and returns its Program without waiting for it. Limits left at None use the defaults."""
+    program = Program(allocate_pid(), name, source,
+                      DEFAULT_CPU_LIMIT if cpu_limit is None else cpu_limit,
+                      DEFAULT_WALL_LIMIT if wall_limit is None else wall_limit,
+                      DEFAULT_MEMORY_LIMIT if memory_limit is None else memory_limit,
+                      DEFAULT_OUTPUT_LIMIT if output_limit is None else output_limit)
+    programs[program.pid] = program
+
+    if _context is None:
+        threading.Thread(target=_serve_in_thread, args=(program,), daemon=True).start()
+        return program
+
+    program.worker = _take_worker()
+    program.cpu_base = _process_cpu(program.worker.process.pid)
+    program.status = "running"
+    limits = (program.cpu_limit, program.memory_limit, program.output_limit)
+    program.worker.conn.send(("run", source, limits, trace.enabled))
+    threading.Thread(target=_serve, args=(program,), daemon=True).start()
+    return program
+
+
+def wait(program, timeout=None):
+    """Waits for a program to finish and returns its result, or None if it is still running."""
+    program.done.wait(timeout)
+    return program.result
+
+
+def kill(pid):
+    program = programs.get(pid)
+    if program is None or program.worker is None:
+        return False
+    with _lock:
+        if program.status != "running":
+            return False
+        program.finish("killed", "Script Error: killed")
+    program.worker.process.kill()
+    return True
+
+
+def restart(pid):
+    """Kills a program (if it still runs) and starts it again, returns the new Program."""
+    program = programs.get(pid)
+    if program is None:
+        return None
+    kill(pid)
+    return spawn(program.source, program.name, program.cpu_limit, program.wall_limit, program.memory_limit, program.output_limit)
+
+
+def reap():
+    """Returns every known program and forgets the finished ones (they stay in finished, for 'usage')."""
+    listing = sorted(programs.values(), key=lambda p: p.pid)
+    for program in listing:
+        if program.done.is_set() and programs.pop(program.pid, None) is not None:
+            finished.append(program)
+    return listing
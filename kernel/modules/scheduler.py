@@ -0,0 +1,158 @@
+# --------TASK SCHEDULER--------
+# The kernel mainloop runs an asyncio event loop. Programs that use await at the top level
+# (e.g. 'await api.async_sleep(1)') run on it as tasks, so hundreds of mostly idle programs
+# can share this one thread instead of each needing an OS thread or a worker process.
+# Tasks are cooperative: a task that never awaits holds up every other task.
+
+asyncio = __elaptic_registry__['asyncio']
+interpreter = __elaptic_registry__['interpreter']
+keyboard = __elaptic_registry__['keyboard']
+procpool = __elaptic_registry__['procpool']
+time = __elaptic_registry__['time']
+console = __elaptic_registry__['console']
+import types
+import threading
+import collections
+
+loop = None
+tasks = {}  # pid -> procpool.Program, finished tasks stay until reap() picks them up
+finished = collections.deque(maxlen=procpool.USAGE_HISTORY)  # what reap() dropped, newest last
+_loop_ready = threading.Event()
+_key_waiters = []  # futures of tasks waiting in next_key()
+
+
+def run():
+    """The kernel mainloop: runs the event loop every task shares. Never returns."""
+    global loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    keyboard.add_key_listener(_on_key)
+    loop.call_soon(_loop_ready.set)
+    loop.run_forever()
+
+
+def _on_key(event):
+    # Called from the keyboard thread
+    loop.call_soon_threadsafe(_wake_key_waiters, event)
+
+
+def _wake_key_waiters(event):
+    waiters = _key_waiters[:]
+    _key_waiters.clear()
+    for future in waiters:
+        if not future.done():
+            future.set_result(event)
+
+
+async def next_key(timeout=None):
+    """Waits for the next key press and returns its name, or keyboard.last_key on timeout."""
+    future = loop.create_future()
+    _key_waiters.append(future)
+    try:
+        event = await asyncio.wait_for(future, timeout)
+        return event.key
+    except asyncio.TimeoutError:
+        return keyboard.last_key
+    finally:
+        if future in _key_waiters:
+            _key_waiters.remove(future)
+
+
+@types.coroutine
+def _timed(coroutine, program):
+    """
+    Drives coroutine step by step and adds the CPU time of every step to program.cpu. Tasks are
+    cooperative, so a CPU quota can only be enforced at the next await: the task gets a QuotaExceeded there.
+    """
+    value, error = None, None
+    while True:
+        started = time.thread_time()
+        try:
+            if error is not None:
+                yielded = coroutine.throw(error)
+            else:
+                yielded = coroutine.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            program.cpu += time.thread_time() - started
+        try:
+            value, error = (yield yielded), None
+        except BaseException as e:  # cancellation and timeouts go on into the script
+            value, error = None, e
+        if error is None and program.cpu_limit and program.cpu > program.cpu_limit and program.quota is None:
+            program.quota = "cpu"
+            value, error = None, interpreter.QuotaExceeded("CPU time limit exceeded")
+
+
+async def _run_timed(program):
+    # A task can't wait for its console buffer to drain without stalling the loop, its oldest output goes instead
+    output = interpreter.OutputMeter(console.Stream(program.pid, block=False), program.output_limit)
+    try:
+        return await _timed(interpreter.run_script_async(program.source, output), program)
+    finally:
+        console.close(program.pid)
+        program.output_bytes = output.bytes
+        if output.exceeded:
+            program.quota = "output"
+
+
+async def _run(program):
+    procpool.current_program.set(program)  # every task runs in its own copy of the context
+    try:
+        if program.wall_limit:
+            result = await asyncio.wait_for(_run_timed(program), program.wall_limit)
+        else:
+            result = await _run_timed(program)
+    except asyncio.TimeoutError:
+        program.finish("timeout", "Script Error: wall-clock time limit exceeded")
+        return
+    except asyncio.CancelledError:
+        if not program.done.is_set():
+            program.finish("killed", "Script Error: killed")
+        raise
+    program.finish("quota" if program.quota else "done", result)
+
+
+def spawn(source: str, name="<task>", wall_limit=None, cpu_limit=None, output_limit=None):
+    """
+    Schedules a program as a task on the kernel event loop and returns its Program right away.
+    Tasks share the kernel's memory, so there is no memory quota or peak for them.
+    """
+    _loop_ready.wait()
+    program = procpool.Program(procpool.allocate_pid(), name, source,
+                               procpool.DEFAULT_CPU_LIMIT if cpu_limit is None else cpu_limit,
+                               procpool.DEFAULT_WALL_LIMIT if wall_limit is None else wall_limit,
+                               None,
+                               procpool.DEFAULT_OUTPUT_LIMIT if output_limit is None else output_limit)
+    program.status = "running"
+    tasks[program.pid] = program
+    program.future = asyncio.run_coroutine_threadsafe(_run(program), loop)
+    return program
+
+
+def kill(pid):
+    program = tasks.get(pid)
+    if program is None or program.status != "running":
+        return False
+    program.finish("killed", "Script Error: killed")
+    program.future.cancel()  # cancels the task on the loop thread
+    return True
+
+
+def restart(pid):
+    """Kills a task (if it still runs) and schedules it again, returns the new Program."""
+    program = tasks.get(pid)
+    if program is None:
+        return None
+    kill(pid)
+    return spawn(program.source, program.name, program.wall_limit, program.cpu_limit, program.output_limit)
+
+
+def reap():
+    """Returns every known task and forgets the finished ones (they stay in finished, for 'usage')."""
+    listing = sorted(tasks.values(), key=lambda p: p.pid)
+    for program in listing:
+        if program.done.is_set() and tasks.pop(program.pid, None) is not None:
+            finished.append(program)
+    return listing
@@ -3,50 +3,383 @@
 interpreter = __elaptic_registry__['interpreter']
 api = __elaptic_registry__['api']
 _thread = __elaptic_registry__['_thread']
-ede = __elaptic_registry__['ede']
+vfs = __elaptic_registry__['vfs']
+sys = __elaptic_registry__['sys']
+time = __elaptic_registry__['time']
+trace = __elaptic_registry__['trace']
+import io
+# ede, procpool and scheduler load lazily/in the background, so they are looked up when a command needs them
+
+# --- Command registry ---
+# Every shell command is a function taking (arguments, directory), arguments being the words after
+# the command name. Modules can add their own with register_command (or the @command decorator),
+# the help menu is built from whatever is registered.
+
+class Command:
+    def __init__(self, name, function, usage, description, direct):
+        self.name = name
+        self.function = function
+        self.run = trace.traced("shell", name)(function)
+        self.usage = usage
+        self.description = description
+        self.direct = direct # writes to the terminal itself (worker processes, the desktop), batch mode flushes before it runs
+
+commands = {} # name -> Command
+
+def register_command(name, function, usage = "", description = "", direct = False):
+    """Adds a shell command, or replaces the one with the same name. Returns function so it also works as a decorator."""
+    commands[name] = Command(name, function, usage, description, direct)
+    return function
+
+def command(name, usage = "", description = "", direct = False):
+    """Decorator version of register_command."""
+    return lambda function: register_command(name, function, usage, description, direct)
+
+LIMIT_NAMES = {"cpu": "cpu_limit", "wall": "wall_limit", "mem": "memory_limit", "out": "output_limit"}
+SIZE_UNITS = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+
+def parse_size(text):
+    """Bytes from things like 4096, 64k or 10M."""
+    unit = SIZE_UNITS.get(text[-1:].lower())
+    return int(float(text[:-1]) * unit) if unit else int(text)
+
+def format_size(size):
+    if size is None:
+        return "-"
+    for suffix, unit in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= unit:
+            return f"{size / unit:.1f}{suffix}"
+    return f"{size}B"
+
+def parse_limits(arguments):
+    """Picks cpu=<seconds>, wall=<seconds>, mem=<size> and out=<size> out of command arguments."""
+    limits = dict.fromkeys(LIMIT_NAMES.values())
+    for argument in arguments:
+        key, _, value = argument.partition("=")
+        if key in LIMIT_NAMES and value:
+            limits[LIMIT_NAMES[key]] = parse_size(value) if key in ("mem", "out") else float(value)
+    return limits
+
+def start_program(arguments):
+    """Programs using top-level await become tasks on the kernel event loop, everything else gets a worker process."""
+    script_content = vfs.read_text(arguments[0])
+    limits = parse_limits(arguments[1:])
+    if interpreter.is_async_script(script_content):
+        return __elaptic_registry__['scheduler'].spawn(script_content, arguments[0], limits["wall_limit"], limits["cpu_limit"], limits["output_limit"])
+    return __elaptic_registry__['procpool'].spawn(script_content, arguments[0], **limits)
+
+def kill_program(pid):
+    return __elaptic_registry__['procpool'].kill(pid) or __elaptic_registry__['scheduler'].kill(pid)
+
+def print_boot_times():
+    registry = __elaptic_registry__
+    print("Module import times (including modules they pulled in):")
+    for name, seconds in sorted(registry.boot_times.items(), key=lambda entry: -entry[1]):
+        print(f"    {name:<16} {seconds * 1000:8.2f} ms")
+    for name in sorted(registry.pending):
+        print(f"    {name:<16}  not loaded yet")
+    if registry.prompt_ready is not None:
+        print(f"Kernel start to first prompt: {(registry.prompt_ready - registry.boot_started) * 1000:.2f} ms")
+
+# --- Built-in commands ---
+
+@command("help", "", "Displays the help menu.")
+def help_command(arguments, directory):
+    print("\nElapticOS Guide:")
+    for entry in commands.values():
+        lines = entry.description.split("\n")
+        print(f"    {(entry.name + ' ' + entry.usage).strip():<34}| {lines[0]}")
+        for line in lines[1:]:
+            print(f"    {'':<34}| {line}")
+    print()
+
+@command("run", "<directory to .py file>", "Runs a python program, add cpu=<s>, wall=<s>, mem=<size> or out=<size>\n"
+         "to limit its CPU time, run time, peak memory or printed bytes.", direct=True)
+def run_command(arguments, directory):
+    program = start_program(arguments)
+    try:
+        print(__elaptic_registry__['procpool'].wait(program))
+    except KeyboardInterrupt: # ctrl-c stops the program, not the kernel
+        kill_program(program.pid)
+        print(f"\nKilled program {program.pid}")
+
+@command("bg", "<directory to .py file>", "Runs a python program in the background.", direct=True)
+def bg_command(arguments, directory):
+    program = start_program(arguments)
+    print(f"Started '{program.name}' as pid {program.pid}")
+
+@command("ps", "", "Lists programs and tasks started with run/bg.")
+def ps_command(arguments, directory):
+    print("  PID  KIND  STATUS     RUNTIME  NAME")
+    listing = [(program, "proc") for program in __elaptic_registry__['procpool'].reap()]
+    listing += [(program, "task") for program in __elaptic_registry__['scheduler'].reap()]
+    for program, kind in sorted(listing, key=lambda entry: entry[0].pid):
+        print(f"{program.pid:>5}  {kind}  {program.status:<8} {program.runtime():8.1f}s  {program.name}")
+
+@command("usage", "", "Lists what every program used: CPU, run time, peak memory and printed bytes.")
+def usage_command(arguments, directory):
+    print("  PID  KIND  STATUS      CPU S    WALL S   PEAK MEM    OUTPUT  QUOTA   NAME")
+    for pid, (program, kind, cpu) in sorted(program_cpu_times(finished=True).items()):
+        print(f"{pid:>5}  {kind}  {program.status:<8} {cpu:8.2f} {program.runtime():9.2f} {format_size(program.peak_memory):>10}"
+              f" {format_size(program.output_bytes):>9}  {program.quota or '-':<6}  {program.name}")
+
+@command("quota", "[cpu=] [wall=] [mem=] [out=]", "Shows or sets the default limits for new programs, 'none' removes one.")
+def quota_command(arguments, directory):
+    procpool = __elaptic_registry__['procpool']
+    defaults = {"cpu": "DEFAULT_CPU_LIMIT", "wall": "DEFAULT_WALL_LIMIT", "mem": "DEFAULT_MEMORY_LIMIT", "out": "DEFAULT_OUTPUT_LIMIT"}
+    for argument in arguments:
+        key, _, value = argument.partition("=")
+        if key not in defaults or not value:
+            print(f"Unknown limit '{argument}'")
+            return
+        if value == "none":
+            setattr(procpool, defaults[key], None)
+        else:
+            setattr(procpool, defaults[key], parse_size(value) if key in ("mem", "out") else float(value))
+    for key, name in defaults.items():
+        value = getattr(procpool, name)
+        shown = format_size(value) if key in ("mem", "out") and value is not None else value
+        print(f"    {key:<5} {'none' if value is None else shown}")
+
+@command("kill", "<pid>", "Stops a program.")
+def kill_command(arguments, directory):
+    if len(arguments) < 1:
+        print("kill requires two arguments!")
+        return
+    if kill_program(int(arguments[0])):
+        print(f"Killed program {arguments[0]}")
+    else:
+        print(f"No running program with pid {arguments[0]}")
+
+@command("restart", "<pid>", "Stops a program and starts it again.")
+def restart_command(arguments, directory):
+    if len(arguments) < 1:
+        print("restart requires two arguments!")
+        return
+    pid = int(arguments[0])
+    procpool = __elaptic_registry__['procpool']
+    program = procpool.restart(pid) if pid in procpool.programs else __elaptic_registry__['scheduler'].restart(pid)
+    if program is None:
+        print(f"No program with pid {arguments[0]}")
+    else:
+        print(f"Restarted '{program.name}' as pid {program.pid}")
+
+@command("touch", "<file>", "Creates a empty file.")
+def touch_command(arguments, directory):
+    api.touch(arguments[0])
+
+@command("rm", "<file>", "Deletes a file.")
+def rm_command(arguments, directory):
+    if len(arguments) < 1:
+        print("rm requires two arguments!")
+        return
+    if api.rm(arguments[0]):
+        print(f"Removed file '{arguments[0]}'")
+    else:
+        print(f"Failed to remove file '{arguments[0]}'")
+
+@command("ls", "[directory]", "Lists a directory, without dotfiles (caches like the desktop's icon index).")
+def ls_command(arguments, directory):
+    for name in vfs.listdir(arguments[0] if arguments else directory):
+        if not name.startswith("."):
+            print(name)
+
+@command("sync", "", "Writes buffered file changes to disk.")
+def sync_command(arguments, directory):
+    for path, error in vfs.sync().items():
+        print(f"Couldn't write {path}: {error}")
+
+@command("ede", "[fps] [stats] [colors=]", "Runs the de, optionally capped at fps and showing frame stats.\n"
+         "Enter starts a program, tab switches between program windows, esc leaves.\n"
+         "colors=truecolor|256|16 picks how colors are sent to the terminal,\n"
+         "record=<file> saves every frame for replay.", direct=True)
+def ede_command(arguments, directory):
+    target_fps = 30
+    color_mode = None
+    recording_path = None
+    for argument in arguments:
+        if argument.isdigit() and int(argument) > 0:
+            target_fps = int(argument)
+        elif argument.startswith("colors="):
+            color_mode = argument[len("colors="):]
+        elif argument.startswith("record="):
+            recording_path = argument[len("record="):]
+    ede = __elaptic_registry__['ede']
+    output = None
+    launched = []
+    if recording_path:
+        recording = io.BytesIO()
+        output = __elaptic_registry__['pixel'].FrameRecorder(recording, __elaptic_registry__['console'].FrameOutput())
+    try:
+        launched = ede.desktop_main(target_fps, "stats" in arguments, color_mode, output)
+    finally:
+        if recording_path:
+            vfs.write(recording_path, recording.getvalue())
+    if ede.frame_stats:
+        print(f"\nLast desktop session: {ede.frame_stats}")
+    for program in launched:
+        print(f"Started '{program.name}' as pid {program.pid}")
+    return 1
+
+@command("replay", "<file> [speed]", "Plays back frames saved with ede record=<file>.", direct=True)
+def replay_command(arguments, directory):
+    speed = float(arguments[1]) if len(arguments) > 1 else 1.0
+    __elaptic_registry__['pixel'].replay_frames(vfs.read_view(arguments[0]), __elaptic_registry__['console'].FrameOutput(), speed)
+    print()
+
+@command("boot", "", "Shows how long each kernel module took to load.")
+def boot_command(arguments, directory):
+    print_boot_times()
+
+def program_cpu_times(finished = False):
+    """{pid: (Program, kind, CPU seconds)} for every program and task the kernel knows about, without reaping them.
+    With finished, the ones 'ps' already reaped are in there too."""
+    procpool, scheduler = __elaptic_registry__['procpool'], __elaptic_registry__['scheduler']
+    sources = [(procpool.programs.values(), "proc"), (scheduler.tasks.values(), "task")]
+    if finished:
+        sources += [(procpool.finished, "proc"), (scheduler.finished, "task")]
+    listing = {}
+    for programs, kind in sources:
+        for program in list(programs):
+            listing[program.pid] = (program, kind, program.cpu_time())
+    return listing
+
+def format_top(elapsed, before, after, programs_before, programs_after):
+    """One screen of 'top', rates are over the elapsed seconds between the two snapshots. Spans count in the
+    window they finish in, so a long one (a whole worker program) can show more than 100% CPU."""
+    (totals_before, counters_before), (totals_after, counters_after) = before, after
+    lines = [f"top - every {elapsed:.1f} s, tracing {'on' if trace.enabled else 'off'}, {len(trace.events)} events buffered", ""]
+
+    # Per subsystem (span category), with its busiest spans under it
+    categories = {}
+    for key, (calls, wall_ns, cpu_ns) in totals_after.items():
+        old_calls, old_wall_ns, old_cpu_ns = totals_before.get(key, (0, 0, 0))
+        rates = (calls - old_calls, wall_ns - old_wall_ns, cpu_ns - old_cpu_ns)
+        if not rates[0]:
+            continue # nothing new in this window
+        category = categories.setdefault(key[0], [[0, 0, 0], []])
+        category[0] = [total + rate for total, rate in zip(category[0], rates)]
+        category[1].append((key[1], rates))
+    lines.append(f"{'SUBSYSTEM':<24} {'CALLS/S':>10} {'CPU %':>7} {'WALL MS/S':>10}")
+    for name, (rates, spans) in sorted(categories.items(), key=lambda entry: -entry[1][0][2]):
+        for label, (calls, wall_ns, cpu_ns) in [(name, rates)] + [("  " + span_name, span_rates) for span_name, span_rates in sorted(spans, key=lambda entry: -entry[1][2])]:
+            lines.append(f"{label:<24} {calls / elapsed:>10.1f} {cpu_ns / elapsed / 1e7:>7.1f} {wall_ns / elapsed / 1e6:>10.2f}")
+    if not categories:
+        lines.append("(nothing traced in this window)")
+
+    if counters_after:
+        lines += ["", f"{'COUNTER':<24} {'TOTAL':>14} {'PER SEC':>12}"]
+        for name, value in sorted(counters_after.items()):
+            lines.append(f"{name:<24} {value:>14,} {(value - counters_before.get(name, 0)) / elapsed:>12,.1f}")
+
+    lines += ["", "  PID  KIND  STATUS     CPU S   CPU %  NAME"]
+    for pid, (program, kind, cpu) in sorted(programs_after.items()):
+        old_cpu = programs_before.get(pid, (None, None, 0.0))[2]
+        lines.append(f"{pid:>5}  {kind}  {program.status:<8} {cpu:7.2f} {(cpu - old_cpu) / elapsed * 100:7.1f}  {program.name}")
+    return "\n".join(lines)
+
+@command("top", "[interval] [count]", "Shows CPU time and call rates per subsystem and program, live.\n"
+         "Refreshes every interval seconds (1) until ctrl-c or count refreshes.")
+def top_command(arguments, directory):
+    interval = float(arguments[0]) if arguments else 1.0
+    live = sys.stdout.isatty()
+    count = int(arguments[1]) if len(arguments) > 1 else (None if live else 1) # batch mode gets one screen
+    was_enabled = trace.enabled
+    trace.enable() # nothing to show otherwise
+    before, programs_before, started = trace.snapshot(), program_cpu_times(), time.perf_counter()
+    shown = 0
+    try:
+        while count is None or shown < count:
+            time.sleep(interval)
+            after, programs_after, now = trace.snapshot(), program_cpu_times(), time.perf_counter()
+            if live:
+                print("\033[H\033[2J", end="")
+            print(format_top(now - started, before, after, programs_before, programs_after), flush=live)
+            before, programs_before, started = after, programs_after, now
+            shown += 1
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if not was_enabled:
+            trace.disable()
+
+@command("trace", "[on|off|clear|save <file>]", "Turns kernel tracing on or off, or saves it as Chrome trace JSON.")
+def trace_command(arguments, directory):
+    action = arguments[0] if arguments else ""
+    if action == "on":
+        trace.enable()
+    elif action == "off":
+        trace.disable()
+    elif action == "clear":
+        trace.clear()
+    elif action == "save" and len(arguments) > 1:
+        trace.save_chrome(arguments[1])
+        print(f"Saved {len(trace.events)} events to '{arguments[1]}'")
+        return
+    elif action:
+        print("usage: trace [on|off|clear|save <file>]")
+        return
+    print(f"Tracing is {'on' if trace.enabled else 'off'}, {len(trace.events)} events buffered")
+
+@command("exit", "", "Stops the kernel.")
+def exit_command(arguments, directory):
+    quit()
+
+# --- Running commands ---
 
 def run_shell_command(command: str, directory =  "/"):
     tokenized_command = command.split()
     if len(tokenized_command) < 1: return
+    entry = commands.get(tokenized_command[0])
+    if entry is None:
+        print(f"Invalid command: {command}")
+        return
     try:
-        if tokenized_command[0] == "help":
-            print("""
-            ElapticOS Guide:
-                help                        | Displays the help menu.
-                run <directory to .py file> | Runs a python program.
-                touch                       | Creates a empty file.
-                rm  <file>                  | Deletes a file.
-                ede                         | Runs the de.
-                exit                        | Stops the kernel.
-            """)
-
-        elif tokenized_command[0] == "run": # Run python program
-            with open(f"fs/{tokenized_command[1]}", "r") as f:
-
-                script_content = f.read()
-
-                print(interpreter.run_script(script_content))
-
-        elif tokenized_command[0] == "touch": # Create empty file
-            api.touch(tokenized_command[1])
-
-        elif tokenized_command[0] == "rm": # Remove file
-            if len(tokenized_command) < 2:
-                print("rm requires two arguments!")
-                return
-            if api.rm(tokenized_command[1]):
-                print(f"Removed file '{tokenized_command[1]}'")
-            else:
-                print(f"Failed to remove file '{tokenized_command[1]}'")
-
-        elif tokenized_command[0] == "ede":
-            ede.desktop_main()
-            return 1
-
-        elif tokenized_command[0] == "exit":
-            quit()
-
-        else:
-            print(f"Invalid command: {command}")
+        return entry.run(tokenized_command[1:], directory)
     except Exception as err:
-        print(f"Exception: {repr(err)}")
\ No newline at end of file
+        print(f"Exception: {repr(err)}")
+
+BATCH_FLUSH_SIZE = 64 * 1024 # characters of output collected before batch mode writes them out
+
+def run_batch(lines, output = None, directory = "/"):
+    """
+    Runs commands one after another without prompts, for main.py --script and piped stdin.
+    Blank lines and lines starting with # are skipped. Output is collected and written out in
+    chunks instead of line by line. Returns how many commands ran.
+    """
+    output = output or sys.stdout
+    buffer = io.StringIO()
+    real_stdout = sys.stdout
+    count = 0
+
+    def flush():
+        if buffer.tell():
+            output.write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+        output.flush()
+
+    sys.stdout = buffer
+    try:
+        for line in lines:
+            command = line.strip()
+            if not command or command.startswith("#"):
+                continue
+            count += 1
+            entry = commands.get(command.split()[0])
+            if entry is not None and entry.direct:
+                # Programs (through the console) and the desktop write to the terminal directly, keep the order right
+                flush()
+                sys.stdout = output
+                try:
+                    run_shell_command(command, directory)
+                finally:
+                    sys.stdout = buffer
+                continue
+            run_shell_command(command, directory)
+            if buffer.tell() >= BATCH_FLUSH_SIZE:
+                flush()
+    finally:
+        sys.stdout = real_stdout
+        flush()
+    return count
\ No newline at end of file
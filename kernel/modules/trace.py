@@ -0,0 +1,187 @@
+# --------TRACING--------
+# Spans and counters for the kernel's hot paths (frame renders, exec calls, file I/O, key events).
+# Everything is off by default, and while off a hook is just a flag check and a function call. Once enabled:
+#     with trace.span("render", "ede"): ...      times a block
+#     @trace.traced("api")                       times every call of a function
+#     trace.count("vfs.read_bytes", len(data))   bumps a counter
+# Finished spans land in a ring buffer of recent events and in per-(category, name) totals,
+# which the shell's 'top' turns into rates. save_chrome() writes the ring buffer as Chrome
+# trace-event JSON, open it in chrome://tracing or ui.perfetto.dev.
+
+time = __elaptic_registry__['time']
+os = __elaptic_registry__['os']
+import json
+import functools
+import threading
+import collections
+
+RING_SIZE = 8192  # recent events kept for export
+
+enabled = False
+events = collections.deque(maxlen=RING_SIZE)  # (name, category, start_ns, duration_ns, cpu_ns, pid, thread id, args)
+totals = {}  # (category, name) -> [calls, wall_ns, cpu_ns], times are inclusive of nested spans
+counters = {}  # name -> value
+_lock = threading.Lock()
+_key_listener_added = False
+
+
+def _add(event):
+    # Callers hold _lock
+    events.append(event)
+    total = totals.get((event[1], event[0]))
+    if total is None:
+        totals[(event[1], event[0])] = [1, event[3], event[4]]
+    else:
+        total[0] += 1
+        total[1] += event[3]
+        total[2] += event[4]
+
+
+def _record(name, category, start_ns, duration_ns, cpu_ns, args):
+    with _lock:
+        _add((name, category, start_ns, duration_ns, cpu_ns, os.getpid(), threading.get_ident(), args))
+
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start", "cpu")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.cpu = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, self.category, self.start, time.perf_counter_ns() - self.start,
+                time.thread_time_ns() - self.cpu, self.args)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, category, args=None):
+    """Context manager timing a block, args (a dict) shows up in the exported trace."""
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+def traced(category, name=None):
+    """Decorator, times every call of the function while tracing is on."""
+    def decorate(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, category, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, amount=1):
+    if not enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def instant(name, category, args=None):
+    """Records a zero-length event, like a key press."""
+    if enabled:
+        _record(name, category, time.perf_counter_ns(), 0, 0, args)
+
+
+def _on_key(event):
+    # Keyboard listener, only attached while tracing is on. Latency is press to dispatch.
+    count("keyboard.keys")
+    instant("key", "keyboard", {"key": event.key, "latency_us": round((time.monotonic() - event.time) * 1e6, 1)})
+
+
+def enable():
+    global enabled, _key_listener_added
+    enabled = True
+    if not _key_listener_added and 'keyboard' in __elaptic_registry__:
+        __elaptic_registry__['keyboard'].add_key_listener(_on_key)
+        _key_listener_added = True
+
+
+def disable():
+    global enabled, _key_listener_added
+    enabled = False
+    if _key_listener_added:
+        __elaptic_registry__['keyboard'].remove_key_listener(_on_key)
+        _key_listener_added = False
+
+
+def clear():
+    with _lock:
+        events.clear()
+        totals.clear()
+        counters.clear()
+
+
+def drain():
+    """Takes every recorded event out of the ring buffer, procpool workers send these back to the kernel."""
+    with _lock:
+        drained = list(events)
+        events.clear()
+    return drained
+
+
+def merge(foreign_events):
+    """Adds events recorded in another process (a procpool worker) as if they happened here."""
+    with _lock:
+        for event in foreign_events:
+            _add(event)
+
+
+def snapshot():
+    """Copies of totals and counters, 'top' diffs two of these to get rates."""
+    with _lock:
+        return {key: total[:] for key, total in totals.items()}, dict(counters)
+
+
+def chrome_trace():
+    """The ring buffer as a Chrome trace-event document (a dict, json.dumps it)."""
+    with _lock:
+        recorded = list(events)
+        counter_values = dict(counters)
+    trace_events = []
+    for name, category, start_ns, duration_ns, _, pid, thread_id, args in recorded:
+        event = {"name": name, "cat": category, "ts": start_ns / 1000, "pid": pid, "tid": thread_id}
+        if duration_ns:
+            event["ph"] = "X"
+            event["dur"] = duration_ns / 1000
+        else:
+            event["ph"] = "i"
+            event["s"] = "t"
+        if args:
+            event["args"] = args
+        trace_events.append(event)
+    end = max((event["ts"] + event.get("dur", 0) for event in trace_events), default=0)
+    for name, value in counter_values.items():
+        trace_events.append({"name": name, "ph": "C", "ts": end, "pid": os.getpid(), "args": {"value": value}})
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def save_chrome(path):
+    """Writes the Chrome trace through the vfs."""
+    __elaptic_registry__['vfs'].write(path, json.dumps(chrome_trace()))
@@ -0,0 +1,485 @@
+# --------VIRTUAL FILESYSTEM--------
+# Every file access from api and the shell goes through here instead of building fs/... paths
+# by hand. Paths are normalized and resolved against a mount table. Reads are served from an
+# LRU page cache, and writes are buffered and flushed back to the backend in batches.
+#
+# Backends implement stat/read_range/write/remove/listdir on paths relative to their mount:
+#     HostBackend   - a directory on the host (fs/ is mounted at / by default)
+#     MemoryBackend - tmpfs, gone on reboot (mounted at /tmp by default)
+#     ImageBackend  - every file packed into a single memory-mapped image file
+# Backends that also have view(path) hand out memoryviews; those skip the page cache since
+# their data already sits in memory.
+
+os = __elaptic_registry__['os']
+time = __elaptic_registry__['time']
+diskimage = __elaptic_registry__['diskimage']
+trace = __elaptic_registry__['trace']
+import stat as stat_module
+import atexit
+import posixpath
+import threading
+from collections import OrderedDict, namedtuple
+
+PAGE_SIZE = 4096
+CACHE_PAGES = 2048  # 8 MB of cached file data
+REVALIDATE_INTERVAL = 1.0  # seconds a cached file is trusted before checking its backend again
+WRITEBACK_DELAY = 2.0  # buffered writes older than this get flushed on the next write
+WRITEBACK_LIMIT = 1 << 20  # flush once this many bytes are waiting
+
+FileStat = namedtuple("FileStat", ["size", "mtime_ns", "is_dir"])
+
+
+def normalize(path: str):
+    """Turns any path into a clean absolute one ('a//b/../c' -> '/a/c'), '..' can't climb out of the root."""
+    return posixpath.normpath("/" + str(path).replace("\\", "/").lstrip("/"))
+
+
+def _parent(path):
+    return posixpath.dirname(path) or "/"
+
+
+# --- Backends ---
+
+class HostBackend:
+    """Files live in a directory on the host."""
+    def __init__(self, root):
+        self.root = root
+
+    def _host_path(self, path):
+        return os.path.join(self.root, *[part for part in path.split("/") if part])
+
+    def stat(self, path):
+        try:
+            stat = os.stat(self._host_path(path))
+        except OSError:
+            return None
+        return FileStat(stat.st_size, stat.st_mtime_ns, stat_module.S_ISDIR(stat.st_mode))
+
+    def read_range(self, path, offset, size):
+        with open(self._host_path(path), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def write(self, path, data):
+        host_path = self._host_path(path)
+        os.makedirs(os.path.dirname(host_path), exist_ok=True)
+        with open(host_path, "wb") as f:
+            f.write(data)
+
+    def remove(self, path):
+        os.remove(self._host_path(path))
+
+    def listdir(self, path):
+        return os.listdir(self._host_path(path))
+
+
+class MemoryBackend:
+    """tmpfs: files only live in memory, directories exist as long as something is in them."""
+    implicit_directories = True  # writing a file creates its directories, there's no mkdir
+
+    def __init__(self):
+        self.files = {}  # path -> (bytes, mtime_ns)
+
+    def stat(self, path):
+        if path in self.files:
+            data, mtime_ns = self.files[path]
+            return FileStat(len(data), mtime_ns, False)
+        prefix = path.rstrip("/") + "/"
+        if path == "/" or any(name.startswith(prefix) for name in self.files):
+            return FileStat(0, 0, True)
+        return None
+
+    def read_range(self, path, offset, size):
+        return self.files[path][0][offset:offset + size]
+
+    def write(self, path, data):
+        self.files[path] = (bytes(data), time.time_ns())
+
+    def remove(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        del self.files[path]
+
+    def listdir(self, path):
+        prefix = path.rstrip("/") + "/"
+        names = {name[len(prefix):].split("/")[0] for name in self.files if name.startswith(prefix)}
+        if not names and self.stat(path) is None:
+            raise FileNotFoundError(path)
+        return list(names)
+
+
+class ImageBackend:
+    """
+    Every file packed into one image file (see diskimage for the layout). The image is memory
+    mapped and reads are slices of the mapping, so nothing is read from disk until it is used.
+    Changes go into an in-memory overlay until sync() writes a new image.
+    """
+    implicit_directories = True
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.image = diskimage.DiskImage(image_path) if os.path.exists(image_path) else None
+        self.overlay = MemoryBackend()
+        self.removed = set()  # image files deleted since the last sync
+
+    def _in_image(self, path):
+        return self.image is not None and path in self.image.entries and path not in self.removed
+
+    def stat(self, path):
+        if path in self.overlay.files:
+            return self.overlay.stat(path)
+        if self._in_image(path):
+            _, size, mtime_ns = self.image.entries[path]
+            return FileStat(size, mtime_ns, False)
+        if self.image is not None and path in self.image.directories:
+            return FileStat(0, 0, True)
+        return self.overlay.stat(path)
+
+    def view(self, path):
+        """Returns a whole file as a memoryview without copying it."""
+        if path in self.overlay.files:
+            return memoryview(self.overlay.files[path][0])
+        if self._in_image(path):
+            return self.image.view(path)
+        raise FileNotFoundError(path)
+
+    def read_range(self, path, offset, size):
+        return bytes(self.view(path)[offset:offset + size])
+
+    def write(self, path, data):
+        self.overlay.write(path, data)
+        self.removed.discard(path)
+
+    def remove(self, path):
+        if path not in self.overlay.files and not self._in_image(path):
+            raise FileNotFoundError(path)
+        self.overlay.files.pop(path, None)
+        if self.image is not None and path in self.image.entries:
+            self.removed.add(path)
+
+    def listdir(self, path):
+        names = set()
+        if self.image is not None:
+            prefix = path.rstrip("/") + "/"
+            names = {name for name in self.image.listdir(path) if prefix + name not in self.removed}
+        try:
+            names.update(self.overlay.listdir(path))
+        except FileNotFoundError:
+            if not names and self.stat(path) is None:
+                raise
+        return list(names)
+
+    def sync(self):
+        if not self.overlay.files and not self.removed:
+            return
+        files = {}
+        if self.image is not None:
+            for path, (_, _, mtime_ns) in self.image.entries.items():
+                if path not in self.removed:
+                    files[path] = (self.image.view(path), mtime_ns)
+        files.update(self.overlay.files)
+        diskimage.pack(self.image_path, files)
+        # The old mapping stays alive for as long as someone still holds a view into it
+        self.image = diskimage.DiskImage(self.image_path)
+        self.overlay = MemoryBackend()
+        self.removed.clear()
+
+
+# --- Mount Table ---
+
+mounts = {}  # mount point -> backend
+_lock = threading.RLock()
+
+
+def mount(mount_point: str, backend):
+    with _lock:
+        sync()
+        mounts[normalize(mount_point)] = backend
+        _drop_all_pages()
+
+
+def unmount(mount_point: str):
+    with _lock:
+        sync()
+        mounts.pop(normalize(mount_point), None)
+        _drop_all_pages()
+
+
+def _resolve(path):
+    """Returns (backend, path relative to its mount) for a normalized path, longest mount point wins."""
+    mount_point = path
+    while True:
+        backend = mounts.get(mount_point)
+        if backend is not None:
+            relative = "/" + path[len(mount_point):].lstrip("/")
+            return backend, relative
+        if mount_point == "/":
+            raise FileNotFoundError(f"nothing mounted for {path}")
+        mount_point = _parent(mount_point)
+
+
+# --- Page Cache ---
+
+_pages = OrderedDict()  # (path, page number) -> bytes, oldest first
+_file_pages = {}  # path -> set of cached page numbers
+_meta = {}  # path -> (FileStat or None, monotonic time it was checked)
+cache_hits = 0
+cache_misses = 0
+
+
+def _drop_pages(path):
+    for page_number in _file_pages.pop(path, ()):
+        _pages.pop((path, page_number), None)
+    _meta.pop(path, None)
+
+
+def _drop_all_pages():
+    _pages.clear()
+    _file_pages.clear()
+    _meta.clear()
+
+
+def _store_page(path, page_number, page):
+    _pages[(path, page_number)] = page
+    _file_pages.setdefault(path, set()).add(page_number)
+    while len(_pages) > CACHE_PAGES:
+        (old_path, old_number), _ = _pages.popitem(last=False)
+        numbers = _file_pages.get(old_path)
+        if numbers is not None:
+            numbers.discard(old_number)
+            if not numbers:
+                del _file_pages[old_path]
+
+
+def _cached_stat(path, backend, relative):
+    now = time.monotonic()
+    meta = _meta.get(path)
+    if meta is not None and now - meta[1] < REVALIDATE_INTERVAL:
+        return meta[0]
+    stat = backend.stat(relative)
+    if meta is not None and meta[0] != stat:
+        _drop_pages(path)  # changed behind our back
+    _meta[path] = (stat, now)
+    return stat
+
+
+# --- Write-Back Buffer ---
+
+_dirty = OrderedDict()  # path -> (bytes, monotonic time first buffered, time.time_ns() of the last write), oldest first
+_dirty_bytes = 0
+
+
+def _flush(path):
+    # The entry stays buffered until its backend took it, so a failed write loses nothing
+    global _dirty_bytes
+    data = _dirty[path][0]
+    backend, relative = _resolve(path)
+    backend.write(relative, data)
+    del _dirty[path]
+    _dirty_bytes -= len(data)
+    _drop_pages(path)
+
+
+@trace.traced("vfs")
+def sync():
+    """
+    Writes every buffered change back to its backend (and image backends to their image file).
+    Returns {path: error} for what couldn't be written, those stay buffered and get retried later.
+    """
+    failed = {}
+    with _lock:
+        for path in list(_dirty):
+            try:
+                _flush(path)
+            except OSError as e:
+                failed[path] = e
+                data, _, mtime_ns = _dirty.pop(path)
+                _dirty[path] = (data, time.monotonic(), mtime_ns)  # not again on every write, only once it's old again
+        for mount_point, backend in mounts.items():
+            if hasattr(backend, "sync"):
+                try:
+                    backend.sync()
+                except OSError as e:
+                    failed[mount_point] = e
+    return failed
+
+
+atexit.register(sync)
+
+
+# --- File API ---
+
+def stat(path: str):
+    """Returns a FileStat, or None if nothing exists at path."""
+    return _stat(normalize(path))
+
+
+def _stat(path):
+    with _lock:
+        if path in _dirty:
+            data, _, mtime_ns = _dirty[path]
+            return FileStat(len(data), mtime_ns, False)
+        if path in mounts:
+            return FileStat(0, 0, True)
+        backend, relative = _resolve(path)
+        return _cached_stat(path, backend, relative)
+
+
+def exists(path: str):
+    return stat(path) is not None
+
+
+def read(path: str, offset=0, size=-1):
+    """Reads size bytes (everything if negative) starting at offset."""
+    global cache_hits, cache_misses
+    path = normalize(path)
+    with _lock:
+        if path in _dirty:
+            data = _dirty[path][0]
+            return data[offset:] if size < 0 else data[offset:offset + size]
+
+        backend, relative = _resolve(path)
+        if hasattr(backend, "view"):
+            data = backend.view(relative)
+            return bytes(data[offset:] if size < 0 else data[offset:offset + size])
+        file_stat = _cached_stat(path, backend, relative)
+        if file_stat is None or file_stat.is_dir:
+            raise FileNotFoundError(path)
+        end = file_stat.size if size < 0 else min(file_stat.size, offset + size)
+        if offset >= end:
+            return b""
+
+        first = offset // PAGE_SIZE
+        pages = []
+        for page_number in range(first, (end - 1) // PAGE_SIZE + 1):
+            page = _pages.get((path, page_number))
+            if page is not None:
+                _pages.move_to_end((path, page_number))
+            pages.append(page)
+
+        # Fetch runs of missing pages with one backend read each
+        index = 0
+        while index < len(pages):
+            if pages[index] is not None:
+                cache_hits += 1
+                index += 1
+                continue
+            run_start = index
+            while index < len(pages) and pages[index] is None:
+                index += 1
+            data = backend.read_range(relative, (first + run_start) * PAGE_SIZE, (index - run_start) * PAGE_SIZE)
+            trace.count("vfs.backend_read_bytes", len(data))
+            for page_index in range(run_start, index):
+                start = (page_index - run_start) * PAGE_SIZE
+                pages[page_index] = data[start:start + PAGE_SIZE]
+                _store_page(path, first + page_index, pages[page_index])
+            cache_misses += index - run_start
+
+        data = b"".join(pages)
+        start = offset - first * PAGE_SIZE
+        return data[start:start + end - offset]
+
+
+def read_view(path: str):
+    """Returns a whole file as a memoryview. For memory-mapped backends this doesn't copy anything."""
+    path = normalize(path)
+    with _lock:
+        if path not in _dirty:
+            backend, relative = _resolve(path)
+            if hasattr(backend, "view"):
+                return backend.view(relative)
+        return memoryview(read(path))
+
+
+def read_text(path: str):
+    return read(path).decode("utf-8")
+
+
+def _check_writable(path):
+    # Callers hold _lock. What the backend would refuse has to fail here, in the write that caused it,
+    # and not later in the flush, in some other program's write or sync.
+    if path in _dirty:
+        return  # checked when it was buffered
+    target = _stat(path)
+    if target is not None and target.is_dir:
+        raise IsADirectoryError(path)
+    backend, _ = _resolve(path)
+    parent = _parent(path)
+    while True:
+        parent_stat = _stat(parent)
+        if parent_stat is not None:
+            if not parent_stat.is_dir:
+                raise NotADirectoryError(parent)
+            return
+        if not getattr(backend, "implicit_directories", False):
+            raise FileNotFoundError(f"no directory {parent}")
+        parent = _parent(parent)
+
+
+def write(path: str, data, append=False):
+    """
+    Replaces (or appends to) a file. The write is buffered and reaches the backend on the next flush.
+    Raises right away if path is a directory or its directory doesn't exist.
+    """
+    global _dirty_bytes
+    path = normalize(path)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    with _lock:
+        _check_writable(path)
+        if append and exists(path):
+            data = read(path) + data
+        buffered_since = time.monotonic()
+        if path in _dirty:
+            old_data, buffered_since, _ = _dirty.pop(path)
+            _dirty_bytes -= len(old_data)
+        _drop_pages(path)
+        _dirty[path] = (bytes(data), buffered_since, time.time_ns())
+        _dirty_bytes += len(data)
+        trace.count("vfs.write_bytes", len(data))
+
+        oldest_since = next(iter(_dirty.values()))[1]
+        if _dirty_bytes > WRITEBACK_LIMIT or time.monotonic() - oldest_since > WRITEBACK_DELAY:
+            sync()
+
+
+def remove(path: str):
+    global _dirty_bytes
+    path = normalize(path)
+    with _lock:
+        buffered = _dirty.pop(path, None)
+        if buffered is not None:
+            _dirty_bytes -= len(buffered[0])
+        _drop_pages(path)
+        backend, relative = _resolve(path)
+        try:
+            backend.remove(relative)
+        except FileNotFoundError:
+            if buffered is None:
+                raise
+
+
+def listdir(path: str = "/"):
+    """Returns the sorted names in a directory, including buffered files and mount points."""
+    path = normalize(path)
+    with _lock:
+        backend, relative = _resolve(path)
+        try:
+            names = set(backend.listdir(relative))
+            found = True
+        except (FileNotFoundError, NotADirectoryError):
+            names = set()
+            found = False
+        prefix = path.rstrip("/") + "/"
+        for extra in list(_dirty) + list(mounts):
+            if extra != path and extra.startswith(prefix):
+                names.add(extra[len(prefix):].split("/")[0])
+                found = True
+        if not found:
+            raise FileNotFoundError(path)
+        return sorted(names)
+
+
+# Default mounts
+mount("/", HostBackend("fs"))
+mount("/tmp", MemoryBackend())